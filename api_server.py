@@ -3,15 +3,24 @@ FastAPI сервер для CSV Analysis Agent
 Интеграция с Lovable и другими frontend приложениями
 """
 
+import asyncio
+import functools
+import hashlib
 import os
 import io
 import traceback
+from collections import OrderedDict
+
+import logging
+
+import orjson
 from typing import List, Optional
 from datetime import datetime
 
-from fastapi import FastAPI, File, UploadFile, HTTPException, Form
+from fastapi import FastAPI, File, UploadFile, HTTPException, Form, Query
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.responses import JSONResponse
+from fastapi.middleware.gzip import GZipMiddleware
+from fastapi.responses import ORJSONResponse, StreamingResponse
 from pydantic import BaseModel
 import uvicorn
 from dotenv import load_dotenv
@@ -21,20 +30,86 @@ from csv_agent_api import CSVAnalysisAgentAPI, AVAILABLE_MODELS, DEFAULT_MODEL
 # Загрузка переменных окружения
 load_dotenv()
 
+# Режим отладки: в проде traceback не отдаем клиенту, только в лог
+_DEBUG = bool(int(os.getenv("DEBUG", "0")))
+
+logger = logging.getLogger("api_server")
+
 # Инициализация FastAPI
 app = FastAPI(
     title="CSV Analysis Agent API",
     description="AI-powered CSV analysis with Claude Sonnet 4.5",
-    version="1.0.0"
+    version="1.0.0",
+    default_response_class=ORJSONResponse  # orjson быстрее stdlib json в 2-5 раз
 )
 
+# Лимит размера загружаемого файла (по умолчанию 200 МБ)
+MAX_UPLOAD_BYTES = int(os.getenv("MAX_UPLOAD_BYTES", 200 * 1024 * 1024))
+
+
+class UploadSizeLimitMiddleware:
+    """
+    Отклоняет слишком большие запросы до того, как тело будет прочитано.
+    Content-Length проверяется сразу (413), chunked-загрузки считаются по мере
+    чтения и обрываются при превышении лимита.
+    """
+
+    def __init__(self, app, max_bytes: int):
+        self.app = app
+        self.max_bytes = max_bytes
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            return await self.app(scope, receive, send)
+
+        # Быстрая проверка по заголовку Content-Length
+        for name, value in scope["headers"]:
+            if name == b"content-length":
+                try:
+                    declared = int(value)
+                except ValueError:
+                    break
+                if declared > self.max_bytes:
+                    response = ORJSONResponse(
+                        status_code=413,
+                        content={"detail": f"Файл слишком большой. Лимит: {self.max_bytes} байт."}
+                    )
+                    return await response(scope, receive, send)
+                break
+
+        # Страховка для chunked transfer без Content-Length
+        received = 0
+
+        async def limited_receive():
+            nonlocal received
+            message = await receive()
+            if message["type"] == "http.request":
+                received += len(message.get("body", b""))
+                if received > self.max_bytes:
+                    raise RuntimeError(
+                        f"Тело запроса превысило лимит {self.max_bytes} байт"
+                    )
+            return message
+
+        return await self.app(scope, limited_receive, send)
+
+
+app.add_middleware(UploadSizeLimitMiddleware, max_bytes=MAX_UPLOAD_BYTES)
+
+# Сжатие ответов: результаты анализа с base64-графиками занимают сотни КБ,
+# gzip сокращает их в несколько раз
+app.add_middleware(GZipMiddleware, minimum_size=1024)
+
 # CORS для работы с Lovable и другими frontend
+# В продакшене задать CORS_ORIGINS списком доменов через запятую
+_cors_origins = os.getenv("CORS_ORIGINS", "*").split(",")
 app.add_middleware(
     CORSMiddleware,
-    allow_origins=["*"],  # В продакшене указать конкретные домены
+    allow_origins=_cors_origins,
     allow_credentials=True,
-    allow_methods=["*"],
-    allow_headers=["*"],
+    allow_methods=["GET", "POST", "OPTIONS"],
+    allow_headers=["Content-Type", "Authorization"],
+    max_age=86400,  # Кэш preflight на сутки — меньше OPTIONS-запросов от браузера
 )
 
 # API ключ для OpenRouter
@@ -53,7 +128,7 @@ if not OPENROUTER_API_KEY.startswith("sk-"):
         f"Текущий ключ начинается с: '{OPENROUTER_API_KEY[:10]}...'"
     )
 
-print(f"✓ OpenRouter API ключ загружен: {OPENROUTER_API_KEY[:10]}...{OPENROUTER_API_KEY[-4:]}")
+logger.info("✓ OpenRouter API ключ загружен: %s...%s", OPENROUTER_API_KEY[:10], OPENROUTER_API_KEY[-4:])
 
 
 # Pydantic модели для валидации
@@ -74,6 +149,134 @@ class AnalyzeWithHistoryRequest(BaseModel):
     chat_history: Optional[List[HistoryItem]] = None
 
 
+# Допустимые расширения и content-type для загружаемых файлов
+_CSV_SUFFIXES = ('.csv', '.csv.gz', '.tsv')
+_CSV_CONTENT_TYPES = {
+    "text/csv",
+    "text/tab-separated-values",
+    "application/csv",
+    "application/gzip",
+    "application/vnd.ms-excel",  # так присылают CSV некоторые браузеры/Excel
+    "application/octet-stream",
+}
+
+
+# Константы для валидации модели: set-проверка и готовая строка для ошибки
+_MODEL_KEYS = frozenset(AVAILABLE_MODELS)
+_MODEL_KEYS_CSV = ", ".join(AVAILABLE_MODELS)
+
+
+# Пул агентов по моделям: переиспользуем инстансы (и их SDK-клиенты)
+# между запросами вместо конструирования агента на каждый запрос
+_agent_pools: dict = {}
+_AGENT_POOL_MAX = 8  # Больше держать нет смысла — ограничено числом одновременных запросов
+
+
+def _acquire_agent(model: str) -> CSVAnalysisAgentAPI:
+    """Взять свободного агента из пула или создать нового"""
+    pool = _agent_pools.setdefault(model, [])
+    if pool:
+        return pool.pop()
+    return CSVAnalysisAgentAPI(api_key=OPENROUTER_API_KEY, model=model)
+
+
+def _release_agent(agent: CSVAnalysisAgentAPI):
+    """Очистить состояние агента и вернуть его в пул"""
+    agent.cleanup()
+    pool = _agent_pools.setdefault(agent.model_key, [])
+    if len(pool) < _AGENT_POOL_MAX:
+        pool.append(agent)
+
+
+def _reject_non_csv(file: UploadFile):
+    """Единая проверка расширения и content-type загруженного файла"""
+    name = (file.filename or "").lower()
+    if not name.endswith(_CSV_SUFFIXES):
+        raise HTTPException(
+            status_code=400,
+            detail=f"Неподдерживаемый формат файла '{file.filename}'. Требуется CSV файл."
+        )
+    if file.content_type and file.content_type not in _CSV_CONTENT_TYPES:
+        raise HTTPException(
+            status_code=400,
+            detail=f"Неподдерживаемый content-type '{file.content_type}'. Требуется CSV файл."
+        )
+    # Поверх общего лимита запроса: отдельный файл тоже не должен превышать лимит
+    # (актуально для chunked-загрузок, где Content-Length запроса отсутствует)
+    if file.size and file.size > MAX_UPLOAD_BYTES:
+        raise HTTPException(
+            status_code=413,
+            detail=f"Файл '{file.filename}' слишком большой. Лимит: {MAX_UPLOAD_BYTES} байт."
+        )
+
+
+# LRU-кэш схем по хэшу содержимого: UI часто шлет один и тот же файл
+# на preview, повторный парсинг не нужен
+_SCHEMA_CACHE_MAX = 64
+_schema_cache: OrderedDict = OrderedDict()
+
+
+def _hash_stream(fileobj) -> str:
+    """Хэш содержимого файлового объекта (поток остается на начале)"""
+    h = hashlib.blake2b(digest_size=16)
+    fileobj.seek(0)
+    while chunk := fileobj.read(1 << 20):
+        h.update(chunk)
+    fileobj.seek(0)
+    return h.hexdigest()
+
+
+# Кэш timestamp с секундной гранулярностью — health-пробы (k8s liveness)
+# бьют эти endpoint'ы постоянно, форматировать время на каждый запрос незачем
+_ts_cache = {"v": datetime.utcnow().isoformat()}
+
+
+async def _refresh_ts():
+    """Фоновое обновление кэшированного timestamp раз в секунду"""
+    while True:
+        await asyncio.sleep(1)
+        _ts_cache["v"] = datetime.utcnow().isoformat()
+
+
+# Ссылка на фоновую задачу: event loop держит task только по weakref,
+# без нее задача может быть собрана GC и timestamp'ы замрут
+_ts_refresher_task: Optional[asyncio.Task] = None
+
+
+@app.on_event("startup")
+async def _start_ts_refresher():
+    global _ts_refresher_task
+    _ts_refresher_task = asyncio.create_task(_refresh_ts())
+
+
+def api_error_handler(fn):
+    """
+    Единая обработка непредвиденных ошибок endpoint'ов:
+    HTTPException пробрасывается как есть, остальное — 500 с деталями
+    """
+    @functools.wraps(fn)
+    async def wrapper(*args, **kwargs):
+        try:
+            return await fn(*args, **kwargs)
+        except HTTPException:
+            raise
+        except Exception as e:
+            logger.exception("Необработанная ошибка в %s", fn.__name__)
+            error_detail = {
+                "error": "Внутренняя ошибка сервера",
+                "message": str(e),
+                "timestamp": datetime.utcnow().isoformat()
+            }
+            # Полный traceback клиенту — только в режиме отладки
+            if _DEBUG:
+                error_detail["traceback"] = traceback.format_exc()
+            return ORJSONResponse(
+                status_code=500,
+                content=error_detail
+            )
+    return wrapper
+
+
 # Health check endpoint
 @app.get("/")
 async def root():
@@ -82,7 +285,7 @@ async def root():
         "status": "online",
         "service": "CSV Analysis Agent API",
         "version": "1.0.0",
-        "timestamp": datetime.utcnow().isoformat()
+        "timestamp": _ts_cache["v"]
     }
 
 
@@ -91,18 +294,12 @@ async def health_check():
     """Health check для мониторинга"""
     return {
         "status": "healthy",
-        "timestamp": datetime.utcnow().isoformat()
+        "timestamp": _ts_cache["v"]
     }
 
 
-@app.get("/api/models")
-async def get_available_models():
-    """
-    Получить список доступных AI моделей для анализа
-
-    Returns:
-        JSON с информацией о доступных моделях
-    """
+def _build_models_payload() -> dict:
+    """Собрать ответ /api/models (AVAILABLE_MODELS — константа, хватит одного раза)"""
     models = []
     for key, info in AVAILABLE_MODELS.items():
         models.append({
@@ -121,83 +318,82 @@ async def get_available_models():
     return {
         "success": True,
         "models": models,
-        "default_model": DEFAULT_MODEL,
-        "timestamp": datetime.utcnow().isoformat()
+        "default_model": DEFAULT_MODEL
     }
 
 
-@app.post("/api/analyze")
-async def analyze_csv(
-    file: UploadFile = File(..., description="CSV файл для анализа"),
-    query: str = Form(..., description="Запрос пользователя для анализа данных"),
-    chat_history: Optional[str] = Form(None, description="История чата в JSON формате"),
-    model: Optional[str] = Form(DEFAULT_MODEL, description="AI модель для анализа (например: claude-sonnet-4.5, gpt-4o)")
-):
-    """
-    Основной endpoint для анализа CSV файла
+# Ответ /api/models не меняется после старта — строим один раз при импорте
+_MODELS_PAYLOAD = _build_models_payload()
 
-    Args:
-        file: Загруженный CSV файл
-        query: Запрос пользователя (например, "Построй график распределения цен")
-        chat_history: JSON строка с историей предыдущих запросов (опционально)
+
+@app.get("/api/models")
+async def get_available_models():
+    """
+    Получить список доступных AI моделей для анализа
 
     Returns:
-        JSON с результатами анализа, включая сгенерированный код,
-        текстовый результат и графики в base64
+        JSON с информацией о доступных моделях
     """
-    agent = None
+    return {**_MODELS_PAYLOAD, "timestamp": _ts_cache["v"]}
+
+
+def _parse_history(chat_history: Optional[str]):
+    """Распарсить JSON-историю чата (или вернуть None)"""
+    if not chat_history:
+        return None
     try:
-        # Проверка формата файла
-        if not file.filename.endswith('.csv'):
-            raise HTTPException(
-                status_code=400,
-                detail="Неподдерживаемый формат файла. Требуется CSV файл."
-            )
+        return orjson.loads(chat_history)
+    except orjson.JSONDecodeError:
+        raise HTTPException(
+            status_code=400,
+            detail="Неверный формат chat_history. Требуется валидный JSON."
+        )
 
-        # Чтение CSV файла
-        file_bytes = await file.read()
-
-        # Парсинг истории если есть
-        history = None
-        if chat_history:
-            import json
-            try:
-                history = json.loads(chat_history)
-            except json.JSONDecodeError:
-                raise HTTPException(
-                    status_code=400,
-                    detail="Неверный формат chat_history. Требуется валидный JSON."
-                )
-
-        # Валидация модели
-        if model not in AVAILABLE_MODELS:
-            raise HTTPException(
-                status_code=400,
-                detail=f"Модель '{model}' не поддерживается. "
-                       f"Доступные модели: {', '.join(AVAILABLE_MODELS.keys())}"
-            )
 
-        # Создание агента с выбранной моделью
-        agent = CSVAnalysisAgentAPI(api_key=OPENROUTER_API_KEY, model=model)
+def _validate_model(model: str):
+    """Проверить что модель поддерживается"""
+    if model not in _MODEL_KEYS:
+        raise HTTPException(
+            status_code=400,
+            detail=f"Модель '{model}' не поддерживается. "
+                   f"Доступные модели: {_MODEL_KEYS_CSV}"
+        )
+
 
-        # Загрузка CSV
+async def _do_analyze(file: UploadFile, query: str, history, model: str) -> ORJSONResponse:
+    """
+    Общий путь анализа одного CSV файла
+    Используется endpoint'ами /api/analyze и /api/quick-analyze
+    """
+    _reject_non_csv(file)
+    _validate_model(model)
+
+    # Берем агента из пула (создается только при первом обращении)
+    agent = _acquire_agent(model)
+    try:
+        # Загрузка CSV потоком (без буферизации всего файла в память)
+        # Блокирующий парсинг уходит в thread pool, чтобы не стопорить event loop
         try:
-            df = agent.load_csv_from_bytes(file_bytes, file.filename)
+            df = await asyncio.to_thread(agent.load_csv_from_stream, file.file, file.filename)
         except Exception as e:
             raise HTTPException(
                 status_code=400,
                 detail=f"Ошибка при чтении CSV файла: {str(e)}"
             )
 
-        # Выполнение анализа
-        result = agent.analyze(query, chat_history=history)
+        # Размер файла: после парсинга поток прочитан до конца
+        size_bytes = file.file.tell()
+
+        # Выполнение анализа (LLM-запросы и exec — тоже в thread pool)
+        result = await asyncio.to_thread(agent.analyze, query, chat_history=history)
 
         # Добавляем информацию о файле и модели
+        rows, cols = df.shape
         result["file_info"] = {
             "filename": file.filename,
-            "size_bytes": len(file_bytes),
-            "rows": df.shape[0],
-            "columns": df.shape[1]
+            "size_bytes": size_bytes,
+            "rows": rows,
+            "columns": cols
         }
         result["model_info"] = {
             "model_key": agent.model_key,
@@ -205,29 +401,38 @@ async def analyze_csv(
             "provider": agent.model_info["provider"]
         }
 
-        return JSONResponse(content=result)
+        return ORJSONResponse(content=result)
 
-    except HTTPException:
-        raise
-    except Exception as e:
-        error_detail = {
-            "error": "Внутренняя ошибка сервера",
-            "message": str(e),
-            "traceback": traceback.format_exc(),
-            "timestamp": datetime.utcnow().isoformat()
-        }
-        return JSONResponse(
-            status_code=500,
-            content=error_detail
-        )
     finally:
-        # Очистка памяти после каждого запроса
-        if agent is not None:
-            agent.cleanup()
-            del agent
+        # Очистка состояния и возврат агента в пул
+        _release_agent(agent)
+
+
+@app.post("/api/analyze")
+@api_error_handler
+async def analyze_csv(
+    file: UploadFile = File(..., description="CSV файл для анализа"),
+    query: str = Form(..., description="Запрос пользователя для анализа данных"),
+    chat_history: Optional[str] = Form(None, description="История чата в JSON формате"),
+    model: Optional[str] = Form(DEFAULT_MODEL, description="AI модель для анализа (например: claude-sonnet-4.5, gpt-4o)")
+):
+    """
+    Основной endpoint для анализа CSV файла
+
+    Args:
+        file: Загруженный CSV файл
+        query: Запрос пользователя (например, "Построй график распределения цен")
+        chat_history: JSON строка с историей предыдущих запросов (опционально)
+
+    Returns:
+        JSON с результатами анализа, включая сгенерированный код,
+        текстовый результат и графики в base64
+    """
+    return await _do_analyze(file, query, _parse_history(chat_history), model)
 
 
 @app.post("/api/schema")
+@api_error_handler
 async def get_csv_schema(
     file: UploadFile = File(..., description="CSV файл"),
     model: Optional[str] = Form(DEFAULT_MODEL, description="AI модель (опционально, для информации)")
@@ -243,20 +448,21 @@ async def get_csv_schema(
     """
     agent = None
     try:
-        if not file.filename.endswith('.csv'):
-            raise HTTPException(
-                status_code=400,
-                detail="Неподдерживаемый формат файла. Требуется CSV файл."
-            )
+        _reject_non_csv(file)
 
-        file_bytes = await file.read()
+        # Схема — чистая функция от содержимого файла: проверяем кэш по хэшу
+        content_hash = await asyncio.to_thread(_hash_stream, file.file)
+        cached = _schema_cache.get(content_hash)
+        if cached is not None:
+            _schema_cache.move_to_end(content_hash)
+            return ORJSONResponse(content={**cached, "filename": file.filename})
 
-        # Создание агента (для schema модель не важна, но сохраняем для единообразия)
-        agent = CSVAnalysisAgentAPI(api_key=OPENROUTER_API_KEY, model=model)
+        # Берем агента из пула (для schema модель не важна, но сохраняем для единообразия)
+        agent = _acquire_agent(model)
 
-        # Загрузка CSV
+        # Загрузка CSV потоком (парсинг в thread pool)
         try:
-            df = agent.load_csv_from_bytes(file_bytes, file.filename)
+            df = await asyncio.to_thread(agent.load_csv_from_stream, file.file, file.filename)
         except Exception as e:
             raise HTTPException(
                 status_code=400,
@@ -264,33 +470,88 @@ async def get_csv_schema(
             )
 
         # Получение схемы
-        schema_info = agent.get_schema_info()
+        schema_info = await asyncio.to_thread(agent.get_schema_info)
+
+        # Кэшируем (без имени файла — оно не часть содержимого)
+        _schema_cache[content_hash] = dict(schema_info)
+        if len(_schema_cache) > _SCHEMA_CACHE_MAX:
+            _schema_cache.popitem(last=False)
 
         # Добавляем имя файла
         schema_info["filename"] = file.filename
 
-        return JSONResponse(content=schema_info)
+        return ORJSONResponse(content=schema_info)
 
-    except HTTPException:
-        raise
-    except Exception as e:
-        error_detail = {
-            "error": "Внутренняя ошибка сервера",
-            "message": str(e),
-            "timestamp": datetime.utcnow().isoformat()
-        }
-        return JSONResponse(
-            status_code=500,
-            content=error_detail
-        )
     finally:
-        # Очистка памяти
+        # Очистка состояния и возврат агента в пул
         if agent is not None:
-            agent.cleanup()
-            del agent
+            _release_agent(agent)
+
+
+@app.post("/api/analyze-stream")
+@api_error_handler
+async def analyze_csv_stream(
+    file: UploadFile = File(..., description="CSV файл для анализа"),
+    query: str = Form(..., description="Запрос пользователя для анализа данных"),
+    chat_history: Optional[str] = Form(None, description="История чата в JSON формате"),
+    model: Optional[str] = Form(DEFAULT_MODEL, description="AI модель для анализа")
+):
+    """
+    Потоковая версия /api/analyze: отдает события анализа как NDJSON
+    (application/x-ndjson) по мере выполнения — текст и графики приходят
+    по отдельности, фронтенд может рендерить первый график не дожидаясь
+    остальных
+
+    Args:
+        file: Загруженный CSV файл
+        query: Запрос пользователя
+        chat_history: JSON строка с историей предыдущих запросов (опционально)
+
+    Returns:
+        Поток NDJSON-событий: status / code / text / plot / done / error
+    """
+    _reject_non_csv(file)
+    _validate_model(model)
+    history = _parse_history(chat_history)
+
+    agent = _acquire_agent(model)
+
+    try:
+        df = await asyncio.to_thread(agent.load_csv_from_stream, file.file, file.filename)
+    except Exception as e:
+        _release_agent(agent)
+        raise HTTPException(
+            status_code=400,
+            detail=f"Ошибка при чтении CSV файла: {str(e)}"
+        )
+
+    size_bytes = file.file.tell()
+    rows, cols = df.shape
+
+    def event_source():
+        # Агент возвращается в пул только после того, как поток дочитан.
+        # OPT_SERIALIZE_NUMPY — как в ORJSONResponse не-стримингового пути:
+        # result_data может содержать numpy-скаляры (np.float64 и т.п.),
+        # без опции dumps падает и обрывает NDJSON-поток посередине
+        try:
+            yield orjson.dumps({
+                "type": "file_info",
+                "filename": file.filename,
+                "size_bytes": size_bytes,
+                "rows": rows,
+                "columns": cols,
+                "model_key": agent.model_key
+            }, option=orjson.OPT_SERIALIZE_NUMPY) + b"\n"
+            for event in agent.analyze_stream(query, chat_history=history):
+                yield orjson.dumps(event, option=orjson.OPT_SERIALIZE_NUMPY) + b"\n"
+        finally:
+            _release_agent(agent)
+
+    return StreamingResponse(event_source(), media_type="application/x-ndjson")
 
 
 @app.post("/api/quick-analyze")
+@api_error_handler
 async def quick_analyze(
     file: UploadFile = File(...),
     query: str = Form(...),
@@ -307,15 +568,17 @@ async def quick_analyze(
     Returns:
         Результаты анализа
     """
-    return await analyze_csv(file=file, query=query, chat_history=None, model=model)
+    return await _do_analyze(file, query, None, model)
 
 
 @app.post("/api/analyze-multi")
+@api_error_handler
 async def analyze_multiple_csv(
     files: List[UploadFile] = File(..., description="Несколько CSV файлов для анализа"),
     query: str = Form(..., description="Запрос пользователя для анализа данных"),
     chat_history: Optional[str] = Form(None, description="История чата в JSON формате"),
-    model: Optional[str] = Form(DEFAULT_MODEL, description="AI модель для анализа")
+    model: Optional[str] = Form(DEFAULT_MODEL, description="AI модель для анализа"),
+    include_columns: bool = Query(False, description="Включить список имен колонок в files_info")
 ):
     """
     Endpoint для анализа нескольких CSV файлов одновременно
@@ -340,95 +603,67 @@ async def analyze_multiple_csv(
 
         # Проверка формата всех файлов
         for file in files:
-            if not file.filename.endswith('.csv'):
-                raise HTTPException(
-                    status_code=400,
-                    detail=f"Неподдерживаемый формат файла '{file.filename}'. Требуется CSV файл."
-                )
-
-        # Чтение всех файлов
-        files_data = []
-        for file in files:
-            file_bytes = await file.read()
-            files_data.append((file_bytes, file.filename))
-
-        # Парсинг истории если есть
-        history = None
-        if chat_history:
-            import json
-            try:
-                history = json.loads(chat_history)
-            except json.JSONDecodeError:
-                raise HTTPException(
-                    status_code=400,
-                    detail="Неверный формат chat_history. Требуется валидный JSON."
-                )
-
-        # Валидация модели
-        if model not in AVAILABLE_MODELS:
-            raise HTTPException(
-                status_code=400,
-                detail=f"Модель '{model}' не поддерживается. "
-                       f"Доступные модели: {', '.join(AVAILABLE_MODELS.keys())}"
-            )
+            _reject_non_csv(file)
+
+        # Передаем файловые объекты напрямую, без накопления байтов в памяти
+        files_data = [(file.file, file.filename) for file in files]
 
-        # Создание агента с выбранной моделью
-        agent = CSVAnalysisAgentAPI(api_key=OPENROUTER_API_KEY, model=model)
+        # Парсинг истории и валидация модели
+        history = _parse_history(chat_history)
+        _validate_model(model)
 
-        # Загрузка всех CSV файлов
+        # Берем агента из пула (создается только при первом обращении)
+        agent = _acquire_agent(model)
+
+        # Загрузка всех CSV файлов (парсинг в thread pool)
         try:
-            loaded_dfs = agent.load_multiple_csv(files_data)
+            loaded_dfs = await asyncio.to_thread(agent.load_multiple_csv, files_data)
         except Exception as e:
             raise HTTPException(
                 status_code=400,
                 detail=f"Ошибка при чтении CSV файлов: {str(e)}"
             )
 
-        # Выполнение анализа
-        result = agent.analyze(query, chat_history=history)
+        # Выполнение анализа (LLM-запросы и exec — в thread pool)
+        result = await asyncio.to_thread(agent.analyze, query, chat_history=history)
 
         # Добавляем информацию о всех файлах
-        result["files_info"] = {
-            name: {
+        # Имена колонок материализуем только по запросу — для широких CSV
+        # это заметный объем в ответе
+        files_info = {}
+        for name, df in loaded_dfs.items():
+            rows, cols = df.shape
+            info = {
                 "filename": name + ".csv",
-                "rows": df.shape[0],
-                "columns": df.shape[1],
-                "column_names": list(df.columns)
+                "rows": rows,
+                "columns": cols
             }
-            for name, df in loaded_dfs.items()
-        }
+            if include_columns:
+                info["column_names"] = list(df.columns)
+            files_info[name] = info
+        result["files_info"] = files_info
         result["model_info"] = {
             "model_key": agent.model_key,
             "model_name": agent.model_info["name"],
             "provider": agent.model_info["provider"]
         }
 
-        return JSONResponse(content=result)
+        return ORJSONResponse(content=result)
 
-    except HTTPException:
-        raise
-    except Exception as e:
-        error_detail = {
-            "error": "Внутренняя ошибка сервера",
-            "message": str(e),
-            "traceback": traceback.format_exc(),
-            "timestamp": datetime.utcnow().isoformat()
-        }
-        return JSONResponse(
-            status_code=500,
-            content=error_detail
-        )
     finally:
-        # Очистка памяти
+        # Очистка состояния и возврат агента в пул
         if agent is not None:
-            agent.cleanup()
-            del agent
+            _release_agent(agent)
 
 
 # Запуск сервера
 if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+
     port = int(os.getenv("PORT", 8000))
     host = os.getenv("HOST", "0.0.0.0")
+    # Количество воркеров: по умолчанию 2*CPU+1 (как у gunicorn)
+    workers = int(os.getenv("WEB_CONCURRENCY", (os.cpu_count() or 1) * 2 + 1))
 
     print(f"""
 ╔════════════════════════════════════════════════════════════╗
@@ -439,6 +674,7 @@ if __name__ == "__main__":
 Server starting...
 - Host: {host}
 - Port: {port}
+- Workers: {workers}
 - Docs: http://{host}:{port}/docs
 - Health: http://{host}:{port}/health
 
@@ -449,6 +685,9 @@ Ready to accept requests!
         "api_server:app",
         host=host,
         port=port,
+        workers=workers,  # Масштабирование на все ядра CPU
+        loop="uvloop",
+        http="httptools",
         reload=False,  # В продакшене должно быть False
         log_level="info"
     )
@@ -6,8 +6,10 @@ AI-агент для анализа CSV файлов - версия для Googl
 import os
 import sys
 import io
-import json
+import hashlib
 import traceback
+from functools import lru_cache
+from pathlib import Path
 from typing import Dict, List, Optional, Tuple, Any
 import contextlib
 
@@ -18,6 +20,110 @@ import seaborn as sns
 from openai import OpenAI
 from IPython.display import display, Image, Markdown
 
+# numba опционален: если установлен, njit отдается в exec-окружение
+# для JIT-компиляции тяжелых числовых циклов
+try:
+    import numba
+except ImportError:
+    numba = None
+
+# Copy-on-Write: в pandas 3.x включен всегда, в 2.x включаем явно —
+# это позволяет отдавать df в exec-код без глубокой копии
+if pd.__version__.startswith('2.'):
+    pd.set_option('mode.copy_on_write', True)
+
+
+# Порог, начиная с которого CSV читается напрямую через pyarrow.csv
+# с memory-mapped вводом вместо pd.read_csv
+_LARGE_CSV_BYTES = 256 * 1024 * 1024
+
+
+def _read_csv_mmap(file_path) -> pd.DataFrame:
+    """
+    Чтение больших CSV через pyarrow.csv с memory-mapped файлом:
+    многопоточный парсинг крупными блоками и почти нулевое копирование
+    при конвертации в pandas (self_destruct освобождает Arrow-буферы)
+    """
+    import pyarrow as pa
+    import pyarrow.csv as pacsv
+
+    with pa.memory_map(str(file_path), 'r') as source:
+        table = pacsv.read_csv(
+            source,
+            read_options=pacsv.ReadOptions(use_threads=True, block_size=16 << 20)
+        )
+    return table.to_pandas(self_destruct=True)
+
+
+# Кэш разобранных CSV в формате Arrow IPC: повторное открытие того же
+# файла (тот же путь, mtime и размер) читается почти со скоростью memcpy
+# вместо полного парсинга CSV
+_ARROW_CACHE_DIR = Path(os.path.expanduser("~/.cache/csv_agent"))
+_ARROW_CACHE_MAX_FILES = 16
+
+
+def _arrow_cache_path(file_path) -> Path:
+    st = os.stat(file_path)
+    key = hashlib.sha1(
+        f"{file_path}|{st.st_mtime_ns}|{st.st_size}".encode()
+    ).hexdigest()
+    return _ARROW_CACHE_DIR / f"{key}.arrow"
+
+
+def _arrow_cache_load(file_path) -> Optional[pd.DataFrame]:
+    """Вернуть DataFrame из Arrow-кэша или None при промахе"""
+    try:
+        cache_path = _arrow_cache_path(file_path)
+        if cache_path.exists():
+            import pyarrow.feather as feather
+            return feather.read_feather(cache_path)
+    except Exception:
+        pass
+    return None
+
+
+def _arrow_cache_store(file_path, df: pd.DataFrame) -> None:
+    """Сохранить DataFrame в Arrow-кэш (ошибки кэша не фатальны)"""
+    try:
+        import pyarrow.feather as feather
+        _ARROW_CACHE_DIR.mkdir(parents=True, exist_ok=True)
+        feather.write_feather(df, _arrow_cache_path(file_path))
+
+        # Простое LRU-выселение: оставляем последние N файлов по mtime
+        cached = sorted(_ARROW_CACHE_DIR.glob("*.arrow"),
+                        key=lambda p: p.stat().st_mtime)
+        for stale in cached[:-_ARROW_CACHE_MAX_FILES]:
+            stale.unlink(missing_ok=True)
+    except Exception:
+        pass
+
+
+def _compact_schema(schema: Dict) -> str:
+    """
+    Компактное текстовое представление схемы для промпта: в разы меньше
+    токенов, чем JSON с отступами, при той же информации
+    """
+    cols = " ".join(
+        f"{col}:{schema['dtypes'][col]}({schema['missing_values'].get(col, 0)})"
+        for col in schema['columns']
+    )
+    lines = [
+        f"- Размер: {schema['shape'][0]} строк, {schema['shape'][1]} колонок",
+        f"- Колонки (имя:тип(пропуски)): {cols}",
+        "- Примеры данных (TSV, первые 5 строк):",
+        "\t".join(str(col) for col in schema['columns']),
+    ]
+    for row in schema['sample_data']:
+        lines.append("\t".join(str(row.get(col, "")) for col in schema['columns']))
+    return "\n".join(lines)
+
+
+@lru_cache(maxsize=128)
+def _compile_user_code(source: str):
+    """Кэш байткода сгенерированного кода: повторные попытки с тем же
+    текстом не проходят заново через парсер и компилятор"""
+    return compile(source, "<llm_generated>", "exec")
+
 
 class ColabCSVAgent:
     """
@@ -44,6 +150,8 @@ class ColabCSVAgent:
         self.current_df = None
         self.conversation_history = []
         self.max_retries = 3
+        self._schema_cache = {}  # Кэш схем по идентичности DataFrame
+        self._prev_table = None  # Arrow-таблица результата предыдущего запроса
 
         # Настройки для графиков
         sns.set_style("whitegrid")
@@ -53,6 +161,29 @@ class ColabCSVAgent:
         print("✓ AI CSV Agent инициализирован")
         print(f"✓ Модель: {self.model}")
 
+    @staticmethod
+    def _optimize_dtypes(df: pd.DataFrame) -> pd.DataFrame:
+        """
+        Сжатие типов после загрузки: числовые колонки приводятся к
+        минимально достаточному типу, строковые с низкой кардинальностью —
+        к category. Заметно уменьшает объем в памяти на типичных CSV.
+        """
+        n_rows = len(df)
+        if n_rows == 0:
+            return df
+
+        for col in df.columns:
+            dtype = df[col].dtype
+            if pd.api.types.is_integer_dtype(dtype):
+                df[col] = pd.to_numeric(df[col], downcast='integer')
+            elif pd.api.types.is_float_dtype(dtype):
+                df[col] = pd.to_numeric(df[col], downcast='float')
+            elif dtype == object or pd.api.types.is_string_dtype(dtype):
+                if df[col].nunique(dropna=False) / n_rows < 0.5:
+                    df[col] = df[col].astype('category')
+
+        return df
+
     def load_csv_from_upload(self, uploaded_files: dict) -> pd.DataFrame:
         """
         Загрузка CSV из загруженных файлов Colab
@@ -77,9 +208,15 @@ class ColabCSVAgent:
             raise Exception("CSV файл не найден среди загруженных")
 
         # Загружаем DataFrame
-        df = pd.read_csv(io.BytesIO(uploaded_files[csv_file]))
+        try:
+            # Быстрый путь: многопоточный парсер pyarrow (отпускает GIL)
+            df = pd.read_csv(io.BytesIO(uploaded_files[csv_file]), engine='pyarrow')
+        except (ValueError, ImportError):
+            df = pd.read_csv(io.BytesIO(uploaded_files[csv_file]))
+        df = self._optimize_dtypes(df)
         self.current_csv_name = csv_file
         self.current_df = df
+        self._schema_cache.clear()
 
         print(f"✓ Загружен файл: {csv_file}")
         print(f"✓ Размер: {df.shape[0]} строк, {df.shape[1]} колонок")
@@ -97,9 +234,23 @@ class ColabCSVAgent:
         Returns:
             DataFrame
         """
-        df = pd.read_csv(file_path)
+        # Повторное открытие того же файла берем из Arrow-кэша
+        df = _arrow_cache_load(file_path)
+        if df is None:
+            try:
+                if os.path.getsize(file_path) > _LARGE_CSV_BYTES:
+                    # Очень большие файлы: pyarrow.csv поверх memory map
+                    df = _read_csv_mmap(file_path)
+                else:
+                    # Быстрый путь: многопоточный парсер pyarrow (отпускает GIL)
+                    df = pd.read_csv(file_path, engine='pyarrow')
+            except (ValueError, ImportError):
+                df = pd.read_csv(file_path)
+            df = self._optimize_dtypes(df)
+            _arrow_cache_store(file_path, df)
         self.current_csv_name = file_path
         self.current_df = df
+        self._schema_cache.clear()
 
         print(f"✓ Загружен файл: {file_path}")
         print(f"✓ Размер: {df.shape[0]} строк, {df.shape[1]} колонок")
@@ -109,28 +260,61 @@ class ColabCSVAgent:
 
     def analyze_csv_schema(self, df: pd.DataFrame) -> Dict[str, Any]:
         """Анализ схемы CSV"""
+        # Схема неизменного DataFrame не пересчитывается между запросами
+        cached = self._schema_cache.get(id(df))
+        if cached is not None:
+            return cached
+
+        numeric_cols = df.select_dtypes(include=[np.number]).columns
+        summary_stats = {}
+        missing_values = {}
+
+        # describe() уже содержит count — пропуски числовых колонок
+        # выводим из него без второго прохода isnull()
+        if len(numeric_cols) > 0:
+            described = df[numeric_cols].describe()
+            summary_stats = described.to_dict()
+            n_rows = len(df)
+            for col, count in described.loc['count'].items():
+                missing_values[col] = int(n_rows - count)
+
+        # isnull() сканируем только по нечисловым колонкам
+        other_cols = [col for col in df.columns if col not in set(numeric_cols)]
+        if other_cols:
+            null_counts = df[other_cols].isnull().sum()
+            missing_values.update(zip(other_cols, null_counts.tolist()))
+
+        # Сэмпл через Arrow: to_pylist() работает в C-ядрах и заметно
+        # быстрее построчного to_dict(orient='records')
+        head = df.head(5)
+        try:
+            import pyarrow as pa
+            sample_data = pa.Table.from_pandas(head, preserve_index=False).to_pylist()
+        except Exception:
+            sample_data = head.to_dict(orient='records')
+
         schema = {
             "columns": list(df.columns),
-            "dtypes": {col: str(dtype) for col, dtype in df.dtypes.items()},
+            # Приведение типов к строкам одним векторизованным вызовом
+            "dtypes": dict(zip(df.columns.tolist(), df.dtypes.astype(str).tolist())),
             "shape": df.shape,
-            "missing_values": df.isnull().sum().to_dict(),
-            "sample_data": df.head(5).to_dict(orient='records'),
-            "summary_stats": {}
+            "missing_values": {col: missing_values[col] for col in df.columns},
+            "sample_data": sample_data,
+            "summary_stats": summary_stats
         }
 
-        numeric_cols = df.select_dtypes(include=[np.number]).columns
-        if len(numeric_cols) > 0:
-            schema["summary_stats"] = df[numeric_cols].describe().to_dict()
-
+        self._schema_cache[id(df)] = schema
         return schema
 
-    def execute_python_code(self, code: str, df: pd.DataFrame) -> Tuple[bool, Any, str, List[str]]:
+    def execute_python_code(self, code: str, df: pd.DataFrame) -> Tuple[bool, Any, str, List[bytes]]:
         """
         Выполнение Python кода с сохранением графиков
 
         Returns:
-            (успех, результат, вывод, список путей к графикам)
+            (успех, результат, вывод, список PNG-байтов графиков)
         """
+        # При Copy-on-Write copy() не копирует данные: буферы общие,
+        # физически копируются только блоки, которые код мутирует
         local_vars = {
             'df': df.copy(),
             'pd': pd,
@@ -140,29 +324,44 @@ class ColabCSVAgent:
             'result': None
         }
 
+        # NumPy-представления числовых колонок: редукции по arr['col']
+        # обходят BlockManager pandas и работают напрямую по массиву
+        local_vars['arr'] = {
+            col: df[col].to_numpy(copy=False)
+            for col in df.select_dtypes(include=[np.number]).columns
+        }
+
+        if numba is not None:
+            local_vars['numba'] = numba
+            local_vars['njit'] = numba.njit
+
+        # DataFrame-результат предыдущего запроса для follow-up вопросов
+        if self._prev_table is not None:
+            local_vars['df_prev'] = self._prev_table.to_pandas()
+
         stdout_capture = io.StringIO()
         stderr_capture = io.StringIO()
-        plot_paths = []
+        plot_images = []
 
         try:
             with contextlib.redirect_stdout(stdout_capture), \
                  contextlib.redirect_stderr(stderr_capture):
 
-                exec(code, local_vars)
+                exec(_compile_user_code(code), local_vars)
                 result = local_vars.get('result', None)
                 output = stdout_capture.getvalue()
 
-                # Сохраняем графики
-                if plt.get_fignums():
-                    for i, fig_num in enumerate(plt.get_fignums()):
-                        fig = plt.figure(fig_num)
-                        fig_path = f"plot_{len(self.conversation_history)}_{fig_num}.png"
-                        fig.savefig(fig_path, bbox_inches='tight', dpi=150)
-                        plot_paths.append(fig_path)
+                # Рендерим графики в память: PNG уходит сразу в display(),
+                # без записи и повторного чтения файла на диске.
+                # Список фигур запрашиваем один раз: финальная очистка
+                # в finally закрывает их без повторного обхода Gcf
+                for fig_num in plt.get_fignums():
+                    fig = plt.figure(fig_num)
+                    buf = io.BytesIO()
+                    fig.savefig(buf, format='png', bbox_inches='tight', dpi=110)
+                    plot_images.append(buf.getvalue())
 
-                    plt.close('all')
-
-                return True, result, output, plot_paths
+                return True, result, output, plot_images
 
         except Exception as e:
             error_msg = f"{type(e).__name__}: {str(e)}\n{traceback.format_exc()}"
@@ -188,22 +387,26 @@ class ColabCSVAgent:
 8. Возвращай ТОЛЬКО код Python, без объяснений и markdown разметки
 9. Не используй print() если не требуется явный вывод
 10. Для графиков используй plt.figure() для создания новых фигур
+11. Используй векторизованные операции pandas/numpy (groupby, merge, булевы маски); избегай df.apply, df.iterrows и циклов по строкам — на больших таблицах они на порядки медленнее
+12. Для быстрых числовых редукций доступен словарь arr: arr['колонка'] — это numpy-массив соответствующей числовой колонки df
 """
 
-        user_message = f"""
-Данные CSV файла:
-- Колонки: {schema['columns']}
-- Типы данных: {schema['dtypes']}
-- Размер: {schema['shape'][0]} строк, {schema['shape'][1]} колонок
-- Пропущенные значения: {schema['missing_values']}
-- Примеры данных (первые 5 строк):
-{json.dumps(schema['sample_data'], indent=2, ensure_ascii=False)}
+        if numba is not None:
+            system_prompt += "13. Для тяжелых числовых циклов (>100 тыс. строк) определяй вспомогательную функцию с @njit(cache=True) и передавай в нее numpy-массивы (arr['колонка'])\n"
 
-Запрос пользователя: {user_query}
-"""
+        if self._prev_table is not None:
+            system_prompt += "14. Переменная df_prev содержит DataFrame-результат предыдущего запроса пользователя; для уточняющих вопросов используй его вместо пересчета с нуля\n"
+
+        # Стабильный блок со схемой: помечаем cache_control, чтобы
+        # OpenRouter/Anthropic кэшировали этот префикс между повторными
+        # попытками и последующими запросами по тому же CSV
+        schema_block = f"""Данные CSV файла:
+{_compact_schema(schema)}"""
+
+        query_block = f"Запрос пользователя: {user_query}"
 
         if previous_error:
-            user_message += f"""
+            query_block += f"""
 
 ПРЕДЫДУЩАЯ ПОПЫТКА ЗАВЕРШИЛАСЬ ОШИБКОЙ:
 {previous_error}
@@ -213,18 +416,42 @@ class ColabCSVAgent:
 
         messages = [
             {"role": "system", "content": system_prompt},
-            {"role": "user", "content": user_message}
+            {
+                "role": "user",
+                "content": [
+                    {"type": "text", "text": schema_block,
+                     "cache_control": {"type": "ephemeral"}},
+                    {"type": "text", "text": query_block}
+                ]
+            }
         ]
 
         try:
-            response = self.client.chat.completions.create(
+            stream = self.client.chat.completions.create(
                 model=self.model,
                 messages=messages,
                 temperature=0.2,
-                max_tokens=4000
+                max_tokens=4000,
+                stream=True,
+                extra_headers={"anthropic-beta": "prompt-caching-2024-07-31"}
             )
 
-            code = response.choices[0].message.content.strip()
+            # Накапливаем дельты по мере прихода; как только после
+            # открывающей ```-ограды встретилась закрывающая, ответ
+            # получен целиком и остаток потока можно не ждать
+            buf = ""
+            for chunk in stream:
+                if not chunk.choices:
+                    continue
+                delta = chunk.choices[0].delta.content
+                if not delta:
+                    continue
+                buf += delta
+                stripped = buf.lstrip()
+                if stripped.startswith("```") and stripped.count("```") >= 2:
+                    break
+
+            code = buf.strip()
 
             # Убираем markdown
             if code.startswith("```python"):
@@ -267,6 +494,7 @@ class ColabCSVAgent:
         }
 
         previous_error = None
+        seen_hashes = set()  # Хэши уже выполнявшегося кода
 
         for attempt in range(self.max_retries):
             display(Markdown(f"### 🔄 Попытка {attempt + 1}/{self.max_retries}"))
@@ -289,8 +517,22 @@ class ColabCSVAgent:
                 display(Markdown(f"❌ **Ошибка:** {result['error']}"))
                 break
 
+            # Если модель вернула тот же код, что и раньше, повторный
+            # запуск даст ту же ошибку — пропускаем и усиливаем подсказку
+            code_hash = hashlib.blake2b(code.encode(), digest_size=16).digest()
+            if code_hash in seen_hashes:
+                display(Markdown("⚠ Модель вернула тот же код, пропускаем выполнение"))
+                result["code_attempts"][-1]["success"] = False
+                result["code_attempts"][-1]["error"] = "Повтор кода предыдущей попытки"
+                previous_error = (previous_error or "") + \
+                    "\nТы вернул тот же код, что и в прошлой попытке. Попробуй другой подход."
+                if attempt == self.max_retries - 1:
+                    result["error"] = f"Не удалось выполнить код после {self.max_retries} попыток"
+                continue
+            seen_hashes.add(code_hash)
+
             # Выполнение кода
-            success, exec_result, output, plot_paths = self.execute_python_code(
+            success, exec_result, output, plot_images = self.execute_python_code(
                 code, self.current_df
             )
 
@@ -309,16 +551,27 @@ class ColabCSVAgent:
                         print(exec_result)
 
                 # Показываем графики
-                if plot_paths:
+                if plot_images:
                     display(Markdown("**Графики:**"))
-                    for plot_path in plot_paths:
-                        display(Image(plot_path))
+                    for plot_png in plot_images:
+                        display(Image(data=plot_png))
 
                 result["success"] = True
                 result["final_result"] = exec_result
                 result["output"] = output
-                result["plots"] = plot_paths
+                result["plots"] = plot_images
                 result["code_attempts"][-1]["success"] = True
+
+                # Результат-DataFrame сохраняем как Arrow-таблицу: следующий
+                # запрос сможет продолжить с него через df_prev
+                if isinstance(exec_result, pd.DataFrame):
+                    try:
+                        import pyarrow as pa
+                        self._prev_table = pa.Table.from_pandas(
+                            exec_result, preserve_index=False
+                        )
+                    except Exception:
+                        self._prev_table = None
                 break
 
             else:
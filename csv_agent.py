@@ -6,8 +6,10 @@ AI-агент для анализа CSV файлов с использовани
 import os
 import sys
 import io
-import json
+import hashlib
 import traceback
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
 from pathlib import Path
 from typing import Dict, List, Optional, Tuple, Any
 import contextlib
@@ -20,6 +22,110 @@ import matplotlib.pyplot as plt
 import seaborn as sns
 from openai import OpenAI
 
+# numba опционален: если установлен, njit отдается в exec-окружение
+# для JIT-компиляции тяжелых числовых циклов
+try:
+    import numba
+except ImportError:
+    numba = None
+
+# Copy-on-Write: в pandas 3.x включен всегда, в 2.x включаем явно —
+# это позволяет отдавать df в exec-код без глубокой копии
+if pd.__version__.startswith('2.'):
+    pd.set_option('mode.copy_on_write', True)
+
+
+# Порог, начиная с которого CSV читается напрямую через pyarrow.csv
+# с memory-mapped вводом вместо pd.read_csv
+_LARGE_CSV_BYTES = 256 * 1024 * 1024
+
+
+def _read_csv_mmap(file_path) -> pd.DataFrame:
+    """
+    Чтение больших CSV через pyarrow.csv с memory-mapped файлом:
+    многопоточный парсинг крупными блоками и почти нулевое копирование
+    при конвертации в pandas (self_destruct освобождает Arrow-буферы)
+    """
+    import pyarrow as pa
+    import pyarrow.csv as pacsv
+
+    with pa.memory_map(str(file_path), 'r') as source:
+        table = pacsv.read_csv(
+            source,
+            read_options=pacsv.ReadOptions(use_threads=True, block_size=16 << 20)
+        )
+    return table.to_pandas(self_destruct=True)
+
+
+# Кэш разобранных CSV в формате Arrow IPC: повторное открытие того же
+# файла (тот же путь, mtime и размер) читается почти со скоростью memcpy
+# вместо полного парсинга CSV
+_ARROW_CACHE_DIR = Path(os.path.expanduser("~/.cache/csv_agent"))
+_ARROW_CACHE_MAX_FILES = 16
+
+
+def _arrow_cache_path(file_path) -> Path:
+    st = os.stat(file_path)
+    key = hashlib.sha1(
+        f"{file_path}|{st.st_mtime_ns}|{st.st_size}".encode()
+    ).hexdigest()
+    return _ARROW_CACHE_DIR / f"{key}.arrow"
+
+
+def _arrow_cache_load(file_path) -> Optional[pd.DataFrame]:
+    """Вернуть DataFrame из Arrow-кэша или None при промахе"""
+    try:
+        cache_path = _arrow_cache_path(file_path)
+        if cache_path.exists():
+            import pyarrow.feather as feather
+            return feather.read_feather(cache_path)
+    except Exception:
+        pass
+    return None
+
+
+def _arrow_cache_store(file_path, df: pd.DataFrame) -> None:
+    """Сохранить DataFrame в Arrow-кэш (ошибки кэша не фатальны)"""
+    try:
+        import pyarrow.feather as feather
+        _ARROW_CACHE_DIR.mkdir(parents=True, exist_ok=True)
+        feather.write_feather(df, _arrow_cache_path(file_path))
+
+        # Простое LRU-выселение: оставляем последние N файлов по mtime
+        cached = sorted(_ARROW_CACHE_DIR.glob("*.arrow"),
+                        key=lambda p: p.stat().st_mtime)
+        for stale in cached[:-_ARROW_CACHE_MAX_FILES]:
+            stale.unlink(missing_ok=True)
+    except Exception:
+        pass
+
+
+def _compact_schema(schema: Dict) -> str:
+    """
+    Компактное текстовое представление схемы для промпта: в разы меньше
+    токенов, чем JSON с отступами, при той же информации
+    """
+    cols = " ".join(
+        f"{col}:{schema['dtypes'][col]}({schema['missing_values'].get(col, 0)})"
+        for col in schema['columns']
+    )
+    lines = [
+        f"- Размер: {schema['shape'][0]} строк, {schema['shape'][1]} колонок",
+        f"- Колонки (имя:тип(пропуски)): {cols}",
+        "- Примеры данных (TSV, первые 5 строк):",
+        "\t".join(str(col) for col in schema['columns']),
+    ]
+    for row in schema['sample_data']:
+        lines.append("\t".join(str(row.get(col, "")) for col in schema['columns']))
+    return "\n".join(lines)
+
+
+@lru_cache(maxsize=128)
+def _compile_user_code(source: str):
+    """Кэш байткода сгенерированного кода: повторные попытки с тем же
+    текстом не проходят заново через парсер и компилятор"""
+    return compile(source, "<llm_generated>", "exec")
+
 
 class CSVAnalysisAgent:
     """
@@ -49,6 +155,7 @@ class CSVAnalysisAgent:
         self.current_df = None
         self.conversation_history = []
         self.max_retries = 3  # Максимум попыток исправления ошибок
+        self._schema_cache = {}  # Кэш схем по идентичности DataFrame
 
         # Настройки для графиков
         sns.set_style("whitegrid")
@@ -60,6 +167,29 @@ class CSVAnalysisAgent:
         csv_files = list(self.working_dir.glob("*.csv"))
         return csv_files
 
+    @staticmethod
+    def _optimize_dtypes(df: pd.DataFrame) -> pd.DataFrame:
+        """
+        Сжатие типов после загрузки: числовые колонки приводятся к
+        минимально достаточному типу, строковые с низкой кардинальностью —
+        к category. Заметно уменьшает объем в памяти на типичных CSV.
+        """
+        n_rows = len(df)
+        if n_rows == 0:
+            return df
+
+        for col in df.columns:
+            dtype = df[col].dtype
+            if pd.api.types.is_integer_dtype(dtype):
+                df[col] = pd.to_numeric(df[col], downcast='integer')
+            elif pd.api.types.is_float_dtype(dtype):
+                df[col] = pd.to_numeric(df[col], downcast='float')
+            elif dtype == object or pd.api.types.is_string_dtype(dtype):
+                if df[col].nunique(dropna=False) / n_rows < 0.5:
+                    df[col] = df[col].astype('category')
+
+        return df
+
     def load_csv(self, file_path: Path) -> pd.DataFrame:
         """
         Загрузить CSV файл
@@ -71,9 +201,24 @@ class CSVAnalysisAgent:
             DataFrame с данными
         """
         try:
-            df = pd.read_csv(file_path)
+            # Повторное открытие того же файла берем из Arrow-кэша
+            df = _arrow_cache_load(file_path)
+            if df is None:
+                try:
+                    if file_path.stat().st_size > _LARGE_CSV_BYTES:
+                        # Очень большие файлы: pyarrow.csv поверх memory map
+                        df = _read_csv_mmap(file_path)
+                    else:
+                        # Быстрый путь: многопоточный парсер pyarrow (отпускает GIL)
+                        df = pd.read_csv(file_path, engine='pyarrow')
+                except (ValueError, ImportError):
+                    # Запасной путь: стандартный парсер pandas
+                    df = pd.read_csv(file_path)
+                df = self._optimize_dtypes(df)
+                _arrow_cache_store(file_path, df)
             self.current_csv = file_path
             self.current_df = df
+            self._schema_cache.clear()
             return df
         except Exception as e:
             raise Exception(f"Ошибка при загрузке CSV файла: {str(e)}")
@@ -88,20 +233,50 @@ class CSVAnalysisAgent:
         Returns:
             Словарь с информацией о схеме
         """
+        # Схема неизменного DataFrame не пересчитывается между запросами
+        cached = self._schema_cache.get(id(df))
+        if cached is not None:
+            return cached
+
+        numeric_cols = df.select_dtypes(include=[np.number]).columns
+        summary_stats = {}
+        missing_values = {}
+
+        # Статистика для числовых колонок: describe() уже содержит count,
+        # поэтому пропуски по ним выводим из него без второго прохода isnull()
+        if len(numeric_cols) > 0:
+            described = df[numeric_cols].describe()
+            summary_stats = described.to_dict()
+            n_rows = len(df)
+            for col, count in described.loc['count'].items():
+                missing_values[col] = int(n_rows - count)
+
+        # isnull() сканируем только по нечисловым колонкам
+        other_cols = [col for col in df.columns if col not in set(numeric_cols)]
+        if other_cols:
+            null_counts = df[other_cols].isnull().sum()
+            missing_values.update(zip(other_cols, null_counts.tolist()))
+
+        # Сэмпл через Arrow: to_pylist() работает в C-ядрах и заметно
+        # быстрее построчного to_dict(orient='records')
+        head = df.head(5)
+        try:
+            import pyarrow as pa
+            sample_data = pa.Table.from_pandas(head, preserve_index=False).to_pylist()
+        except Exception:
+            sample_data = head.to_dict(orient='records')
+
         schema = {
             "columns": list(df.columns),
-            "dtypes": {col: str(dtype) for col, dtype in df.dtypes.items()},
+            # Приведение типов к строкам одним векторизованным вызовом
+            "dtypes": dict(zip(df.columns.tolist(), df.dtypes.astype(str).tolist())),
             "shape": df.shape,
-            "missing_values": df.isnull().sum().to_dict(),
-            "sample_data": df.head(5).to_dict(orient='records'),
-            "summary_stats": {}
+            "missing_values": {col: missing_values[col] for col in df.columns},
+            "sample_data": sample_data,
+            "summary_stats": summary_stats
         }
 
-        # Статистика для числовых колонок
-        numeric_cols = df.select_dtypes(include=[np.number]).columns
-        if len(numeric_cols) > 0:
-            schema["summary_stats"] = df[numeric_cols].describe().to_dict()
-
+        self._schema_cache[id(df)] = schema
         return schema
 
     def execute_python_code(self, code: str, df: pd.DataFrame) -> Tuple[bool, Any, str]:
@@ -115,7 +290,15 @@ class CSVAnalysisAgent:
         Returns:
             Кортеж (успех, результат, вывод/ошибка)
         """
-        # Создаем изолированное окружение для выполнения
+        # Код выполняется в worker-потоке пула: интерактивные backend'ы
+        # (TkAgg и т.п.) вне главного потока не поддерживаются, поэтому
+        # возвращаем Agg, если предыдущая попытка кода его переключила
+        if matplotlib.get_backend().lower() != 'agg':
+            plt.switch_backend('Agg')
+
+        # Создаем изолированное окружение для выполнения.
+        # При Copy-on-Write copy() не копирует данные: буферы общие,
+        # физически копируются только блоки, которые код мутирует
         local_vars = {
             'df': df.copy(),
             'pd': pd,
@@ -125,6 +308,17 @@ class CSVAnalysisAgent:
             'result': None
         }
 
+        # NumPy-представления числовых колонок: редукции по arr['col']
+        # обходят BlockManager pandas и работают напрямую по массиву
+        local_vars['arr'] = {
+            col: df[col].to_numpy(copy=False)
+            for col in df.select_dtypes(include=[np.number]).columns
+        }
+
+        if numba is not None:
+            local_vars['numba'] = numba
+            local_vars['njit'] = numba.njit
+
         # Перехватываем stdout и stderr
         stdout_capture = io.StringIO()
         stderr_capture = io.StringIO()
@@ -133,26 +327,27 @@ class CSVAnalysisAgent:
             with contextlib.redirect_stdout(stdout_capture), \
                  contextlib.redirect_stderr(stderr_capture):
 
-                # Выполняем код
-                exec(code, local_vars)
+                # Выполняем код (байткод берется из кэша)
+                exec(_compile_user_code(code), local_vars)
 
                 # Получаем результат
                 result = local_vars.get('result', None)
                 output = stdout_capture.getvalue()
 
-                # Если результат - это matplotlib figure, сохраняем его
-                if plt.get_fignums():
+                # Если результат - это matplotlib figure, сохраняем его.
+                # Список фигур запрашиваем один раз: финальная очистка
+                # в finally закрывает их без повторного обхода Gcf
+                figs = plt.get_fignums()
+                if figs:
                     output_dir = self.working_dir / "outputs"
                     output_dir.mkdir(exist_ok=True)
 
-                    for i, fig_num in enumerate(plt.get_fignums()):
+                    for fig_num in figs:
                         fig = plt.figure(fig_num)
                         fig_path = output_dir / f"plot_{fig_num}.png"
                         fig.savefig(fig_path, bbox_inches='tight', dpi=150)
                         output += f"\n[График сохранен: {fig_path}]"
 
-                    plt.close('all')
-
                 return True, result, output
 
         except Exception as e:
@@ -188,22 +383,23 @@ class CSVAnalysisAgent:
 7. Обрабатывай возможные ошибки (NaN, типы данных и т.д.)
 8. Возвращай ТОЛЬКО код Python, без объяснений и markdown разметки
 9. Не используй print() если не требуется явный вывод
+10. Используй векторизованные операции pandas/numpy (groupby, merge, булевы маски); избегай df.apply, df.iterrows и циклов по строкам — на больших таблицах они на порядки медленнее
+11. Для быстрых числовых редукций доступен словарь arr: arr['колонка'] — это numpy-массив соответствующей числовой колонки df
 """
 
-        user_message = f"""
-Данные CSV файла:
-- Колонки: {schema['columns']}
-- Типы данных: {schema['dtypes']}
-- Размер: {schema['shape'][0]} строк, {schema['shape'][1]} колонок
-- Пропущенные значения: {schema['missing_values']}
-- Примеры данных (первые 5 строк):
-{json.dumps(schema['sample_data'], indent=2, ensure_ascii=False)}
+        if numba is not None:
+            system_prompt += "12. Для тяжелых числовых циклов (>100 тыс. строк) определяй вспомогательную функцию с @njit(cache=True) и передавай в нее numpy-массивы (arr['колонка'])\n"
 
-Запрос пользователя: {user_query}
-"""
+        # Стабильный блок со схемой: помечаем cache_control, чтобы
+        # OpenRouter/Anthropic кэшировали этот префикс между повторными
+        # попытками и последующими запросами по тому же CSV
+        schema_block = f"""Данные CSV файла:
+{_compact_schema(schema)}"""
+
+        query_block = f"Запрос пользователя: {user_query}"
 
         if previous_error:
-            user_message += f"""
+            query_block += f"""
 
 ПРЕДЫДУЩАЯ ПОПЫТКА ЗАВЕРШИЛАСЬ ОШИБКОЙ:
 {previous_error}
@@ -214,19 +410,43 @@ class CSVAnalysisAgent:
         # Добавляем в историю
         messages = [
             {"role": "system", "content": system_prompt},
-            {"role": "user", "content": user_message}
+            {
+                "role": "user",
+                "content": [
+                    {"type": "text", "text": schema_block,
+                     "cache_control": {"type": "ephemeral"}},
+                    {"type": "text", "text": query_block}
+                ]
+            }
         ]
 
         # Отправляем запрос к Claude
         try:
-            response = self.client.chat.completions.create(
+            stream = self.client.chat.completions.create(
                 model=self.model,
                 messages=messages,
                 temperature=0.2,
-                max_tokens=4000
+                max_tokens=4000,
+                stream=True,
+                extra_headers={"anthropic-beta": "prompt-caching-2024-07-31"}
             )
 
-            code = response.choices[0].message.content.strip()
+            # Накапливаем дельты по мере прихода; как только после
+            # открывающей ```-ограды встретилась закрывающая, ответ
+            # получен целиком и остаток потока можно не ждать
+            buf = ""
+            for chunk in stream:
+                if not chunk.choices:
+                    continue
+                delta = chunk.choices[0].delta.content
+                if not delta:
+                    continue
+                buf += delta
+                stripped = buf.lstrip()
+                if stripped.startswith("```") and stripped.count("```") >= 2:
+                    break
+
+            code = buf.strip()
 
             # Убираем markdown разметку если есть
             if code.startswith("```python"):
@@ -269,61 +489,102 @@ class CSVAnalysisAgent:
             "error": None
         }
 
-        # Пробуем выполнить с повторными попытками
+        # Пробуем выполнить с повторными попытками.
+        # Пока код очередной попытки выполняется, спекулятивно запрашиваем
+        # у модели следующий вариант: LLM-запрос (сетевое ожидание) идет
+        # параллельно с exec, и при ошибке не нужен второй круг ожидания
         previous_error = None
+        seen_hashes = set()  # Хэши уже выполнявшегося кода
+        speculative = None   # Future со спекулятивно сгенерированным кодом
+        speculative_hint = (
+            "Предположим, что предыдущий код завершился ошибкой выполнения "
+            "(текст ошибки еще недоступен). Предложи альтернативный вариант "
+            "решения, не повторяя прежний подход."
+        )
+        pool = ThreadPoolExecutor(max_workers=2)
 
-        for attempt in range(self.max_retries):
-            print(f"\n{'='*60}")
-            print(f"Попытка {attempt + 1}/{self.max_retries}")
-            print(f"{'='*60}")
+        try:
+            for attempt in range(self.max_retries):
+                print(f"\n{'='*60}")
+                print(f"Попытка {attempt + 1}/{self.max_retries}")
+                print(f"{'='*60}")
+
+                # Генерируем код (или забираем спекулятивно сгенерированный)
+                try:
+                    if speculative is not None:
+                        code = speculative.result()
+                        speculative = None
+                    else:
+                        code = self.generate_code_with_retry(user_query, schema, previous_error)
+                    print(f"\nСгенерированный код:")
+                    print("-" * 60)
+                    print(code)
+                    print("-" * 60)
+
+                    result["code_attempts"].append({
+                        "attempt": attempt + 1,
+                        "code": code
+                    })
+
+                except Exception as e:
+                    result["error"] = f"Ошибка генерации кода: {str(e)}"
+                    break
 
-            # Генерируем код
-            try:
-                code = self.generate_code_with_retry(user_query, schema, previous_error)
-                print(f"\nСгенерированный код:")
-                print("-" * 60)
-                print(code)
-                print("-" * 60)
-
-                result["code_attempts"].append({
-                    "attempt": attempt + 1,
-                    "code": code
-                })
-
-            except Exception as e:
-                result["error"] = f"Ошибка генерации кода: {str(e)}"
-                break
+                # Если модель вернула тот же код, что и раньше, повторный
+                # запуск даст ту же ошибку — пропускаем и усиливаем подсказку
+                code_hash = hashlib.blake2b(code.encode(), digest_size=16).digest()
+                if code_hash in seen_hashes:
+                    print("\n⚠ Модель вернула тот же код, пропускаем выполнение")
+                    result["code_attempts"][-1]["success"] = False
+                    result["code_attempts"][-1]["error"] = "Повтор кода предыдущей попытки"
+                    previous_error = (previous_error or "") + \
+                        "\nТы вернул тот же код, что и в прошлой попытке. Попробуй другой подход."
+                    if attempt == self.max_retries - 1:
+                        result["error"] = f"Не удалось выполнить код после {self.max_retries} попыток"
+                    continue
+                seen_hashes.add(code_hash)
+
+                # Выполняем код в отдельном потоке, параллельно запуская
+                # спекулятивную генерацию следующей попытки
+                exec_future = pool.submit(self.execute_python_code, code, self.current_df)
+                if attempt < self.max_retries - 1:
+                    speculative = pool.submit(
+                        self.generate_code_with_retry, user_query, schema, speculative_hint
+                    )
+                success, exec_result, output = exec_future.result()
+
+                if success:
+                    print(f"\n✓ Код выполнен успешно!")
+                    print(f"\nРезультат:")
+                    print("-" * 60)
+                    if output:
+                        print(output)
+                    if exec_result is not None:
+                        print(f"Возвращаемое значение: {exec_result}")
+                    print("-" * 60)
+
+                    result["success"] = True
+                    result["final_result"] = exec_result
+                    result["output"] = output
+                    result["code_attempts"][-1]["success"] = True
+                    break
+                else:
+                    print(f"\n✗ Ошибка выполнения:")
+                    print("-" * 60)
+                    print(output)
+                    print("-" * 60)
 
-            # Выполняем код
-            success, exec_result, output = self.execute_python_code(code, self.current_df)
+                    previous_error = output
+                    result["code_attempts"][-1]["success"] = False
+                    result["code_attempts"][-1]["error"] = output
 
-            if success:
-                print(f"\n✓ Код выполнен успешно!")
-                print(f"\nРезультат:")
-                print("-" * 60)
-                if output:
-                    print(output)
-                if exec_result is not None:
-                    print(f"Возвращаемое значение: {exec_result}")
-                print("-" * 60)
-
-                result["success"] = True
-                result["final_result"] = exec_result
-                result["output"] = output
-                result["code_attempts"][-1]["success"] = True
-                break
-            else:
-                print(f"\n✗ Ошибка выполнения:")
-                print("-" * 60)
-                print(output)
-                print("-" * 60)
-
-                previous_error = output
-                result["code_attempts"][-1]["success"] = False
-                result["code_attempts"][-1]["error"] = output
-
-                if attempt == self.max_retries - 1:
-                    result["error"] = f"Не удалось выполнить код после {self.max_retries} попыток"
+                    if attempt == self.max_retries - 1:
+                        result["error"] = f"Не удалось выполнить код после {self.max_retries} попыток"
+        finally:
+            # Ненужный спекулятивный запрос отменяем и не ждем при выходе
+            if speculative is not None:
+                speculative.cancel()
+            pool.shutdown(wait=False, cancel_futures=True)
 
         # Сохраняем в историю
         self.conversation_history.append({
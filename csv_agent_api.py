@@ -6,11 +6,19 @@ Julius.ai style - многоэтапный анализ с красивым вы
 
 import os
 import io
-import json
+import re
+import csv
+import asyncio
+import hashlib
+import threading
 import traceback
+import multiprocessing
 import gc
 from pathlib import Path
 from typing import Dict, List, Optional, Tuple, Any
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
 import contextlib
 import base64
 from datetime import datetime
@@ -19,9 +27,144 @@ import pandas as pd
 import numpy as np
 import matplotlib
 matplotlib.use('Agg')
+from matplotlib._pylab_helpers import Gcf
+
+# Copy-on-Write: в pandas 3.x включен всегда, в 2.x включаем явно —
+# тогда copy() не копирует данные до первой мутации
+if pd.__version__.startswith('2.'):
+    pd.set_option('mode.copy_on_write', True)
+
+# Порог "большого" файла: выше него читаем поблочно через pyarrow
+# и не держим полную копию оригинала в памяти
+_LARGE_CSV_BYTES = 100 * 1024 * 1024
+
+# Изоляция exec-кода в форкнутом процессе: жесткие лимиты памяти и
+# wall-clock времени на сгенерированный код. По умолчанию выключена —
+# fork из рабочих потоков сервера безопасен не во всех окружениях
+EXEC_ISOLATION = os.getenv("EXEC_ISOLATION", "0") == "1"
+EXEC_TIMEOUT_SECONDS = int(os.getenv("EXEC_TIMEOUT_SECONDS", "30"))
+EXEC_MEMORY_LIMIT_MB = int(os.getenv("EXEC_MEMORY_LIMIT_MB", "2048"))
 import matplotlib.pyplot as plt
 import seaborn as sns
-from openai import OpenAI
+
+# Стиль графиков настраивается один раз на процесс: агент создается
+# на каждый запрос сервера, а set_style и rcParams - глобальные
+# побочные эффекты matplotlib (включая прогрев кэша шрифтов)
+if not getattr(matplotlib, '_csv_agent_styled', False):
+    sns.set_style("whitegrid")
+    plt.rcParams.update({'figure.figsize': (10, 6), 'figure.dpi': 100})
+    matplotlib._csv_agent_styled = True
+
+import httpx
+import orjson
+from openai import OpenAI, AsyncOpenAI
+
+
+# Общий HTTP-клиент для всех агентов: держит keep-alive соединения
+# к openrouter.ai вместо нового TCP+TLS рукопожатия на каждый запрос
+_http_client = None
+_async_http_client = None
+
+
+def _get_http_client() -> httpx.Client:
+    global _http_client
+    if _http_client is None:
+        limits = httpx.Limits(max_connections=100, max_keepalive_connections=50)
+        try:
+            # HTTP/2 мультиплексирует запросы по одному соединению
+            _http_client = httpx.Client(http2=True, timeout=120.0, limits=limits)
+        except ImportError:
+            # Пакет h2 не установлен — работаем по HTTP/1.1 с keep-alive
+            _http_client = httpx.Client(timeout=120.0, limits=limits)
+    return _http_client
+
+
+def _get_async_http_client() -> httpx.AsyncClient:
+    global _async_http_client
+    if _async_http_client is None:
+        limits = httpx.Limits(max_connections=100, max_keepalive_connections=50)
+        try:
+            _async_http_client = httpx.AsyncClient(http2=True, timeout=120.0, limits=limits)
+        except ImportError:
+            _async_http_client = httpx.AsyncClient(timeout=120.0, limits=limits)
+    return _async_http_client
+
+
+# Кэш сгенерированного кода: повторные и слегка перефразированные запросы
+# (другой регистр, пунктуация, лишние пробелы) не платят за LLM round-trip.
+# Эмбеддинги с порогом косинусной близости сюда не тянем — это тяжелые
+# зависимости; нормализованное совпадение покрывает типовые повторы из UI.
+# Кэш общий для всех агентов процесса, ключ включает модель и схему данных
+_CODE_CACHE_MAX = 256
+_code_cache = OrderedDict()
+_code_cache_lock = threading.Lock()
+
+# exec сгенерированного кода и сбор фигур работают с процесс-глобальным
+# состоянием (pyplot/Gcf, подмена sys.stdout). Сервер гоняет analyze через
+# asyncio.to_thread, так что два запроса могут выполняться одновременно —
+# без сериализации один запрос забирает (или закрывает) графики другого
+_exec_lock = threading.Lock()
+
+
+def _normalize_query(user_query: str) -> str:
+    """Нормализация запроса для ключа кэша: регистр, пунктуация, пробелы"""
+    return " ".join(re.sub(r"[^\w\s]", " ", user_query.lower()).split())
+
+
+def _code_cache_get(key: str) -> Optional[str]:
+    with _code_cache_lock:
+        code = _code_cache.get(key)
+        if code is not None:
+            _code_cache.move_to_end(key)
+        return code
+
+
+def _code_cache_put(key: str, code: str):
+    with _code_cache_lock:
+        _code_cache[key] = code
+        _code_cache.move_to_end(key)
+        while len(_code_cache) > _CODE_CACHE_MAX:
+            _code_cache.popitem(last=False)
+
+
+def _code_cache_drop(key: str):
+    with _code_cache_lock:
+        _code_cache.pop(key, None)
+
+
+# Ограда ```python ... ``` вокруг сгенерированного кода
+_FENCE_RE = re.compile(r"^```(?:python)?\s*\n?(.*?)\n?```\s*$", re.DOTALL)
+
+
+class _ListSink:
+    """
+    Легкий приемник для redirect_stdout/redirect_stderr: каждый print
+    из exec-кода - это просто append в список, без учета позиции и
+    буферизации StringIO. Итоговая строка собирается одним join
+    """
+
+    def __init__(self):
+        self.parts = []
+
+    def write(self, s: str) -> int:
+        self.parts.append(s)
+        return len(s)
+
+    def flush(self):
+        pass
+
+    def isatty(self) -> bool:
+        return False
+
+    def getvalue(self) -> str:
+        return "".join(self.parts)
+
+
+@lru_cache(maxsize=128)
+def _compile_user_code(source: str):
+    """Кэш байткода сгенерированного кода: повторные попытки с тем же
+    текстом не проходят заново через парсер и компилятор"""
+    return compile(source, "<llm_generated>", "exec")
 
 
 # Конфигурация доступных моделей
@@ -78,6 +221,157 @@ class CSVAnalysisAgentAPI:
     Поддерживает историю диалога и возвращает результаты в формате API
     """
 
+    # Статический префикс системного промпта: он байт-в-байт одинаков
+    # между запросами, поэтому провайдер кэширует его токены целиком.
+    # Динамическая часть (список DataFrame'ов) уходит отдельным блоком
+    STATIC_SYSTEM_PROMPT = """Ты эксперт-аналитик данных, работающий как Julius.ai.
+
+🎯 ТВОЯ ЗАДАЧА: Писать код который работает ПОЭТАПНО и ЛОГИРУЕТ каждый шаг.
+
+📋 ОБЯЗАТЕЛЬНАЯ СТРУКТУРА КОДА:
+
+```python
+# === ШАГ 1: ПОНИМАНИЕ ДАННЫХ ===
+print("🔍 ШАГ 1: Изучаю структуру данных...")
+print(f"Размер данных: {len(df)} строк, {len(df.columns)} колонок")
+print(f"Колонки: {list(df.columns)}")
+
+# === ШАГ 2: ПРОВЕРКА И ОЧИСТКА ===
+print("\\n🧹 ШАГ 2: Проверяю качество данных...")
+
+# Ищем нужные колонки (гибкий поиск)
+def find_column(df, keywords):
+    for col in df.columns:
+        col_lower = str(col).lower()
+        if any(keyword.lower() in col_lower for keyword in keywords):
+            return col
+    return None
+
+year_col = find_column(df, ['year', 'год', 'date'])
+amount_col = find_column(df, ['amount', 'сумма', 'total', 'value'])
+
+if not year_col or not amount_col:
+    result = f"❌ Ошибка: не найдены нужные колонки. Доступные: {list(df.columns)}"
+else:
+    print(f"✅ Найдены колонки: {year_col}, {amount_col}")
+
+    # Преобразуем типы данных
+    df[year_col] = pd.to_numeric(df[year_col], errors='coerce')
+    df[amount_col] = pd.to_numeric(df[amount_col], errors='coerce')
+
+    # Удаляем строки с пустыми значениями
+    df_clean = df.dropna(subset=[year_col, amount_col])
+    print(f"✅ Данные очищены: {len(df_clean)} валидных строк")
+
+    # === ШАГ 3: АНАЛИЗ ===
+    print("\\n📊 ШАГ 3: Выполняю анализ...")
+
+    # Группировка и агрегация
+    result_df = df_clean.groupby(year_col)[amount_col].sum().reset_index()
+    result_df = result_df.sort_values(year_col)
+
+    print(f"✅ Агрегировано: {len(result_df)} групп")
+
+    # === ШАГ 4: ВИЗУАЛИЗАЦИЯ ===
+    print("\\n📈 ШАГ 4: Создаю визуализацию...")
+
+    plt.figure(figsize=(12, 6))
+    plt.plot(result_df[year_col], result_df[amount_col],
+             marker='o', linewidth=2, markersize=8)
+    plt.title('Динамика показателей', fontsize=16, fontweight='bold')
+    plt.xlabel(year_col, fontsize=12)
+    plt.ylabel(amount_col, fontsize=12)
+    plt.grid(True, alpha=0.3)
+
+    # Форматируем ось Y с запятыми
+    ax = plt.gca()
+    ax.yaxis.set_major_formatter(plt.FuncFormatter(lambda x, p: f'{x:,.0f}'))
+
+    plt.tight_layout()
+    print("✅ График создан")
+
+    # === ШАГ 5: ФОРМАТИРОВАННЫЙ РЕЗУЛЬТАТ ===
+    print("\\n✅ ШАГ 5: Формирую финальный отчет...")
+
+    # Создаем MARKDOWN таблицу (НЕ код-блок!)
+    display_df = result_df.copy()
+
+    # Форматируем числа
+    display_df[amount_col] = display_df[amount_col].apply(lambda x: f"{x:,.0f}")
+
+    # Генерируем Markdown таблицу ВРУЧНУЮ
+    markdown_table = f"| {year_col} | {amount_col} |\\n"
+    markdown_table += "|" + "-" * (len(str(year_col)) + 2) + "|" + "-" * (len(str(amount_col)) + 2) + "|\\n"
+
+    for _, row in display_df.iterrows():
+        markdown_table += f"| {int(row[year_col])} | {row[amount_col]} |\\n"
+
+    # Статистика
+    total_sum = result_df[amount_col].sum()
+    avg_value = result_df[amount_col].mean()
+
+    result = f\"\"\"
+## 📊 Результаты анализа
+
+### 📈 Данные по годам
+
+{markdown_table}
+
+### 📌 Статистика
+
+| Показатель | Значение |
+|------------|----------|
+| Всего записей | {len(df_clean)} |
+| Общая сумма | {total_sum:,.0f} |
+| Среднее значение | {avg_value:,.0f} |
+
+✅ Анализ выполнен успешно
+\"\"\"
+
+    print("✅ Анализ завершен успешно!")
+```
+
+🎯 КЛЮЧЕВЫЕ ПРАВИЛА:
+
+1. **ЛОГИРУЙ КАЖДЫЙ ШАГ** через print():
+   - Что делаешь сейчас
+   - Сколько данных обработано
+   - Какие промежуточные результаты
+
+2. **ИЩИ КОЛОНКИ ГИБКО**:
+   - Используй функцию find_column()
+   - Ищи по ключевым словам
+   - Проверяй существование
+
+3. **ПРОВЕРЯЙ ВСЁ**:
+   - Существование колонок
+   - Типы данных
+   - Пустые значения
+
+4. **ФОРМАТИРУЙ ЧИСЛА**:
+   - В таблицах: `{value:,.0f}` или `{value:,.2f}`
+   - На графиках: `plt.FuncFormatter(lambda x, p: f'{x:,.0f}')`
+
+5. **СОЗДАВАЙ MARKDOWN ТАБЛИЦЫ** (НЕ код-блоки!):
+   - Используй формат: `| Колонка | Значение |`
+   - Разделитель: `|---------|----------|`
+   - Генерируй таблицу циклом или через петлю
+   - НЕ используй ``` вокруг таблиц!
+   - Форматируй числа ПЕРЕД выводом
+
+6. **result В MARKDOWN**:
+   - Заголовки ##, ###
+   - Таблицы НАПРЯМУЮ в Markdown (| col | val |)
+   - Эмодзи для наглядности
+   - **НЕ ПЕЧАТАЙ result через print!**
+   - **НЕ ИСПОЛЬЗУЙ ``` вокруг таблиц данных!**
+
+7. **ОБРАБОТКА ОШИБОК**:
+   - Если колонки не найдены - сообщи об этом в result
+   - Покажи какие колонки доступны
+   - Дай рекомендацию пользователю
+"""
+
     def __init__(self, api_key: str, model: str = DEFAULT_MODEL):
         """
         Инициализация агента
@@ -89,11 +383,9 @@ class CSVAnalysisAgentAPI:
         """
         self.api_key = api_key
 
-        # Инициализация клиента OpenRouter
-        self.client = OpenAI(
-            base_url="https://openrouter.ai/api/v1",
-            api_key=api_key
-        )
+        # Клиенты OpenRouter создаются лениво: schema-запросам LLM не нужен
+        self._client = None
+        self._aclient = None
 
         # Проверка и установка модели
         if model not in AVAILABLE_MODELS:
@@ -107,23 +399,76 @@ class CSVAnalysisAgentAPI:
         self.model_info = AVAILABLE_MODELS[model]  # Полная информация о модели
 
         self.current_df = None
-        self.original_df = None  # Храним оригинал
+        self._original_meta = None  # Метаданные исходного файла (без копии данных)
         self.dataframes = {}  # Хранилище для множественных DataFrame: {filename: df}
         self.max_retries = 3
 
+        # Бюджет истории диалога в токенах (~4 символа на токен)
+        self._history_token_budget = 1500
+
+        # Кэш схем по идентичности DataFrame: схема меняется только
+        # при загрузке нового файла, а не между ретраями и follow-up'ами
+        self._schema_cache = {}
+
+        # Ошибки последней пакетной загрузки: {filename: текст ошибки}
+        self.load_errors = {}
+
+        # Мемоизация динамического хвоста системного промпта:
+        # пересобирается только при смене набора DataFrame'ов
+        self._dyn_prompt_key = None
+        self._dyn_prompt_text = None
+
+        # Кэш сериализованного описания данных для промпта (по id схемы)
+        self._schema_prompt_cache = {}
+
         # Метаданные о данных
         self.data_metadata = {
             "has_unnamed_columns": False,
             "first_row_is_header": False,
             "columns_cleaned": False,
             "rows_removed": 0,
-            "cols_removed": 0
+            "cols_removed": 0,
+            "detected_sep": None
         }
 
-        # Настройки для графиков
-        sns.set_style("whitegrid")
-        plt.rcParams['figure.figsize'] = (10, 6)
-        plt.rcParams['figure.dpi'] = 100
+    # Кэш SDK-клиентов по api_key: агенты из пула сервера делят не
+    # только httpx-пул соединений (общий на процесс), но и сами
+    # обертки OpenAI — новый инстанс агента не строит клиент заново
+    _shared_clients: Dict[str, OpenAI] = {}
+    _shared_aclients: Dict[str, AsyncOpenAI] = {}
+    _clients_lock = threading.Lock()
+
+    @property
+    def client(self) -> OpenAI:
+        """Клиент OpenRouter (общий для агентов с одним api_key)"""
+        if self._client is None:
+            with self._clients_lock:
+                client = self._shared_clients.get(self.api_key)
+                if client is None:
+                    client = OpenAI(
+                        base_url="https://openrouter.ai/api/v1",
+                        api_key=self.api_key,
+                        http_client=_get_http_client()
+                    )
+                    self._shared_clients[self.api_key] = client
+            self._client = client
+        return self._client
+
+    @property
+    def aclient(self) -> AsyncOpenAI:
+        """Асинхронный клиент OpenRouter (общий для агентов с одним api_key)"""
+        if self._aclient is None:
+            with self._clients_lock:
+                aclient = self._shared_aclients.get(self.api_key)
+                if aclient is None:
+                    aclient = AsyncOpenAI(
+                        base_url="https://openrouter.ai/api/v1",
+                        api_key=self.api_key,
+                        http_client=_get_async_http_client()
+                    )
+                    self._shared_aclients[self.api_key] = aclient
+            self._aclient = aclient
+        return self._aclient
 
     def _is_first_row_header(self, df: pd.DataFrame) -> bool:
         """
@@ -134,8 +479,8 @@ class CSVAnalysisAgentAPI:
         2. Первая строка содержит текстовые значения (потенциальные названия)
         3. Вторая строка содержит числовые/смешанные значения (данные)
         """
-        # Проверка 1: Много Unnamed колонок?
-        unnamed_count = sum(1 for col in df.columns if 'Unnamed' in str(col))
+        # Проверка 1: Много Unnamed колонок? (векторизовано по индексу колонок)
+        unnamed_count = df.columns.astype(str).str.contains('Unnamed', regex=False).sum()
         if unnamed_count < len(df.columns) * 0.3:  # Меньше 30% unnamed
             return False
 
@@ -146,20 +491,147 @@ class CSVAnalysisAgentAPI:
         first_row = df.iloc[0]
         second_row = df.iloc[1]
 
-        # Считаем текстовые значения в первой строке
-        text_count_row1 = sum(1 for val in first_row if isinstance(val, str) and not str(val).replace('.', '').replace('-', '').isdigit())
+        # Векторизованные проверки вместо Python-цикла по ячейкам:
+        # to_numeric по всей строке работает одним C-проходом
+
+        # Текстовые значения в первой строке: непустые и не приводимые к числу
+        row1_numeric = pd.to_numeric(first_row, errors='coerce').notna()
+        text_count_row1 = int((~row1_numeric & first_row.notna()).sum())
 
-        # Считаем числовые значения во второй строке
-        numeric_count_row2 = sum(1 for val in second_row if pd.notna(val) and (isinstance(val, (int, float)) or str(val).replace('.', '').replace('-', '').isdigit()))
+        # Числовые значения во второй строке
+        numeric_count_row2 = int(pd.to_numeric(second_row, errors='coerce').notna().sum())
 
         # Если первая строка преимущественно текст, а вторая - числа
         return text_count_row1 > len(first_row) * 0.5 and numeric_count_row2 > len(second_row) * 0.3
 
-    def smart_load_csv(self, file_bytes: bytes, filename: str = "data.csv") -> Dict[str, Any]:
+    def _read_csv_fast(self, file_source, filename: str, meta: Dict) -> pd.DataFrame:
+        """
+        Чтение CSV с быстрым путем через многопоточный pyarrow-парсер.
+        Если pyarrow не справился (нестандартный разделитель и т.п.) —
+        сниффим разделитель и парсим C-движком; python-движок с
+        автоопределением остается последним запасным вариантом.
+
+        Args:
+            file_source: Файловый объект с CSV данными
+            filename: Имя файла (для определения сжатия/разделителя)
+            meta: Локальный словарь метаданных загрузки (detected_sep);
+                  пишем в него, а не в self.data_metadata, чтобы
+                  параллельные загрузки не перемешивали свои флаги
+
+        Returns:
+            DataFrame с данными
+        """
+        # Для потоков pandas не может определить сжатие по имени файла
+        compression = 'gzip' if filename.lower().endswith('.gz') else None
+        start = file_source.tell() if file_source.seekable() else None
+        meta["detected_sep"] = None
+
+        # Размер источника (для выбора поблочного чтения)
+        size = None
+        if start is not None:
+            file_source.seek(0, io.SEEK_END)
+            size = file_source.tell() - start
+            file_source.seek(start)
+
+        # Большие файлы читаем поблочно через pyarrow: ограниченный
+        # block_size держит пиковую память в рамках, а self_destruct
+        # освобождает arrow-буферы по мере конвертации в pandas
+        if size is not None and size > _LARGE_CSV_BYTES and compression is None:
+            try:
+                import pyarrow.csv as pacsv
+                # Разделитель сниффим по первому блоку, как и в ветках
+                # ниже — иначе большой ';'-файл молча вернется одной
+                # колонкой (дефолт pyarrow — запятая)
+                sep = '\t' if filename.lower().endswith('.tsv') else ','
+                try:
+                    sample = file_source.read(65536)
+                    file_source.seek(start)
+                    if isinstance(sample, bytes):
+                        sample = sample.decode('utf-8', errors='replace')
+                    sep = csv.Sniffer().sniff(sample, delimiters=',;\t|').delimiter
+                except csv.Error:
+                    pass
+                table = pacsv.read_csv(
+                    file_source,
+                    read_options=pacsv.ReadOptions(block_size=8 << 20),
+                    parse_options=pacsv.ParseOptions(delimiter=sep)
+                )
+                if table.num_columns > 1:
+                    meta["detected_sep"] = sep
+                    return table.to_pandas(self_destruct=True)
+                file_source.seek(start)
+            except Exception:
+                file_source.seek(start)
+
+        # .tsv сразу идет через автоопределение разделителя
+        if start is not None and not filename.lower().endswith('.tsv'):
+            try:
+                df = pd.read_csv(file_source, engine='pyarrow', compression=compression)
+                # Одна колонка — скорее всего pyarrow не угадал разделитель
+                if df.shape[1] > 1:
+                    meta["detected_sep"] = ','
+                    return df
+            except Exception:
+                pass
+            file_source.seek(start)
+
+        # Сниффим разделитель по первым 64 КБ и читаем C-движком:
+        # он на порядок быстрее python-движка с sep=None
+        if start is not None and compression is None:
+            try:
+                sample = file_source.read(65536)
+                file_source.seek(start)
+                if isinstance(sample, bytes):
+                    sample = sample.decode('utf-8', errors='replace')
+                dialect = csv.Sniffer().sniff(sample, delimiters=',;\t|')
+                df = pd.read_csv(
+                    file_source,
+                    sep=dialect.delimiter,
+                    engine='c',
+                    low_memory=False
+                )
+                if df.shape[1] > 1:
+                    meta["detected_sep"] = dialect.delimiter
+                    return df
+            except Exception:
+                pass
+            file_source.seek(start)
+
+        return pd.read_csv(file_source, sep=None, engine='python', compression=compression)
+
+    @staticmethod
+    def _optimize_dtypes(df: pd.DataFrame) -> pd.DataFrame:
+        """
+        Сжатие типов после загрузки: числовые колонки приводятся к
+        минимально достаточному типу, строковые с низкой кардинальностью —
+        к category. Вдвое меньше байт — вдвое меньше полосы памяти
+        для groupby/describe/графиков.
+        """
+        n_rows = len(df)
+        if n_rows == 0:
+            return df
+
+        for col in df.columns:
+            dtype = df[col].dtype
+            if pd.api.types.is_integer_dtype(dtype):
+                df[col] = pd.to_numeric(df[col], downcast='integer')
+            elif pd.api.types.is_float_dtype(dtype):
+                df[col] = pd.to_numeric(df[col], downcast='float')
+            elif dtype == object or pd.api.types.is_string_dtype(dtype):
+                if df[col].nunique(dropna=False) / n_rows < 0.5:
+                    df[col] = df[col].astype('category')
+
+        return df
+
+    def smart_load_csv(self, file_source, filename: str = "data.csv") -> Dict[str, Any]:
         """
         Умная загрузка CSV с автоматическим анализом структуры
         Работает как Julius.ai - сначала понимает структуру, потом очищает
 
+        Args:
+            file_source: Байты CSV файла или файловый объект (поток)
+            filename: Имя файла
+
         Returns:
             Dict с информацией о загрузке и очистке
         """
@@ -172,17 +644,40 @@ class CSVAnalysisAgentAPI:
             "success": True
         }
 
+        # Метаданные собираем в локальный словарь и публикуем одним
+        # присваиванием в конце: load_multiple_csv зовет этот метод из
+        # пула потоков, и поэлементные записи в self.data_metadata
+        # перемешали бы флаги разных файлов
+        meta = {
+            "has_unnamed_columns": False,
+            "first_row_is_header": False,
+            "columns_cleaned": False,
+            "rows_removed": 0,
+            "cols_removed": 0,
+            "detected_sep": None
+        }
+
         try:
-            # ШАГ 1: Загружаем "как есть"
-            df_raw = pd.read_csv(io.BytesIO(file_bytes), sep=None, engine='python')
-            self.original_df = df_raw.copy()
+            # ШАГ 1: Загружаем "как есть" (байты оборачиваем, потоки читаем напрямую)
+            if isinstance(file_source, (bytes, bytearray)):
+                file_source = io.BytesIO(file_source)
+            df_raw = self._read_csv_fast(file_source, filename, meta)
+            # Полную копию оригинала не держим — она удваивала память
+            # на каждый загруженный файл; для диагностики достаточно
+            # метаданных о структуре до очистки
+            original_meta = {
+                "filename": filename,
+                "shape": df_raw.shape,
+                "columns": df_raw.columns.astype(str).tolist(),
+                "dtypes": df_raw.dtypes.astype(str).to_dict()
+            }
             load_info["original_shape"] = df_raw.shape
             load_info["steps"].append(f"📥 Загружено: {df_raw.shape[0]} строк × {df_raw.shape[1]} колонок")
 
             # ШАГ 2: Проверяем "Unnamed" колонки
             unnamed_cols = [col for col in df_raw.columns if 'Unnamed' in str(col)]
             if unnamed_cols:
-                self.data_metadata["has_unnamed_columns"] = True
+                meta["has_unnamed_columns"] = True
                 load_info["warnings"].append(
                     f"⚠️ Найдено {len(unnamed_cols)} колонок типа 'Unnamed'. "
                     f"Возможно первая строка - это заголовки."
@@ -191,7 +686,7 @@ class CSVAnalysisAgentAPI:
 
             # ШАГ 3: Проверяем первую строку - может это заголовки?
             if self._is_first_row_header(df_raw):
-                self.data_metadata["first_row_is_header"] = True
+                meta["first_row_is_header"] = True
                 load_info["steps"].append("🎯 Обнаружено: первая строка - это заголовки данных")
 
                 # Делаем первую строку заголовком
@@ -207,7 +702,7 @@ class CSVAnalysisAgentAPI:
             cleaned_cols = list(df_raw.columns)
 
             if original_cols != cleaned_cols:
-                self.data_metadata["columns_cleaned"] = True
+                meta["columns_cleaned"] = True
                 load_info["steps"].append("🧹 Очищены названия колонок от лишних пробелов")
 
             # ШАГ 5: Удаляем полностью пустые строки
@@ -217,7 +712,7 @@ class CSVAnalysisAgentAPI:
             rows_removed = rows_before - rows_after
 
             if rows_removed > 0:
-                self.data_metadata["rows_removed"] = rows_removed
+                meta["rows_removed"] = rows_removed
                 load_info["steps"].append(f"🗑️ Удалено {rows_removed} пустых строк")
 
             # ШАГ 6: Удаляем полностью пустые колонки
@@ -227,14 +722,33 @@ class CSVAnalysisAgentAPI:
             cols_removed = cols_before - cols_after
 
             if cols_removed > 0:
-                self.data_metadata["cols_removed"] = cols_removed
+                meta["cols_removed"] = cols_removed
                 load_info["steps"].append(f"🗑️ Удалено {cols_removed} пустых колонок")
 
-            # Сохраняем результат
+            # ШАГ 7: Сжимаем типы данных
+            mem_before = df_raw.memory_usage(deep=True).sum()
+            df_raw = self._optimize_dtypes(df_raw)
+            mem_after = df_raw.memory_usage(deep=True).sum()
+            if mem_after < mem_before:
+                load_info["steps"].append(
+                    f"⚡ Типы данных оптимизированы: "
+                    f"{mem_before / 1024:.0f} КБ → {mem_after / 1024:.0f} КБ"
+                )
+
+            # Сохраняем результат; метаданные публикуем целиком —
+            # одно присваивание атомарно под GIL, при параллельной
+            # загрузке побеждает последний файл (а не смесь всех)
+            self.data_metadata = meta
+            self._original_meta = original_meta
             self.current_df = df_raw.reset_index(drop=True)
             clean_name = Path(filename).stem
             self.dataframes[clean_name] = self.current_df
 
+            # Новый DataFrame — старые схемы невалидны (id может
+            # переиспользоваться после сборки мусора)
+            self._schema_cache.clear()
+            self._schema_prompt_cache.clear()
+
             load_info["final_shape"] = self.current_df.shape
             load_info["steps"].append(
                 f"✅ Итого: {self.current_df.shape[0]} строк × {self.current_df.shape[1]} колонок"
@@ -261,25 +775,155 @@ class CSVAnalysisAgentAPI:
         self.smart_load_csv(file_bytes, filename)
         return self.current_df
 
-    def load_multiple_csv(self, files_data: List[Tuple[bytes, str]]) -> Dict[str, pd.DataFrame]:
+    def load_csv_from_stream(self, fileobj, filename: str = "data.csv") -> pd.DataFrame:
+        """
+        Загрузить CSV из файлового объекта без буферизации в память
+        Большие файлы читаются потоком напрямую в pandas
+
+        Args:
+            fileobj: Файловый объект (например, SpooledTemporaryFile от UploadFile)
+            filename: Имя файла
+
+        Returns:
+            DataFrame с данными
+        """
+        self.smart_load_csv(fileobj, filename)
+        return self.current_df
+
+    @staticmethod
+    def _probe_csv(file_source, filename: str) -> Optional[str]:
+        """
+        Быстрая проверка файла многопоточным pyarrow-ридером: читается
+        только первый блок (заголовок + типы), без материализации файла
+
+        Returns:
+            Текст ошибки или None, если файл выглядит читаемым
+        """
+        if filename.lower().endswith('.gz'):
+            return None  # сжатый сэмпл не проверить без распаковки
+
+        try:
+            import pyarrow as pa
+            import pyarrow.csv as pacsv
+        except ImportError:
+            return None
+
+        try:
+            if isinstance(file_source, (bytes, bytearray)):
+                sample = bytes(file_source[:1 << 20])
+            elif hasattr(file_source, 'seekable') and file_source.seekable():
+                start = file_source.tell()
+                sample = file_source.read(1 << 20)
+                file_source.seek(start)
+            else:
+                return None
+
+            if not isinstance(sample, bytes) or not sample:
+                return "EmptyDataError: файл пуст"
+
+            # Обрезаем возможную незавершенную последнюю строку сэмпла
+            cut = sample.rfind(b'\n')
+            if cut > 0:
+                sample = sample[:cut + 1]
+
+            # Разделитель пробуем угадать так же, как _read_csv_fast,
+            # иначе валидный .tsv с запятыми внутри полей не пройдет пробу
+            delimiter = ','
+            if filename.lower().endswith('.tsv'):
+                delimiter = '\t'
+            else:
+                try:
+                    text_sample = sample[:64 * 1024].decode('utf-8', errors='replace')
+                    delimiter = csv.Sniffer().sniff(
+                        text_sample, delimiters=',;\t|'
+                    ).delimiter
+                except csv.Error:
+                    pass
+
+            reader = pacsv.open_csv(
+                pa.BufferReader(sample),
+                read_options=pacsv.ReadOptions(block_size=1 << 20),
+                parse_options=pacsv.ParseOptions(delimiter=delimiter)
+            )
+            try:
+                reader.read_next_batch()
+            except StopIteration:
+                pass  # только заголовок, без строк — pandas прочтет пустой frame
+            return None
+        except Exception as e:
+            return f"{type(e).__name__}: {str(e)}"
+
+    def load_multiple_csv(self, files_data: List[Tuple[Any, str]]) -> Dict[str, pd.DataFrame]:
         """
         Загрузить несколько CSV файлов одновременно
 
+        Сначала пачка проходит дешевую параллельную валидацию
+        pyarrow-ридером, затем парсинг идет в пуле потоков: токенизатор
+        pandas/pyarrow отпускает GIL, поэтому файлы разбираются
+        параллельно. Битый файл не роняет всю пачку — его ошибка
+        записывается в self.load_errors, остальные файлы загружаются
+
         Args:
-            files_data: Список кортежей (file_bytes, filename)
+            files_data: Список кортежей (file_bytes или файловый объект, filename)
 
         Returns:
-            Словарь {filename: DataFrame}
+            Словарь {filename: DataFrame} успешно загруженных файлов
         """
+        self.load_errors = {}
+        if not files_data:
+            return {}
+
+        max_workers = min(8, len(files_data))
+
+        # Пре-пасс: валидация заголовка и типов без полного чтения
+        with ThreadPoolExecutor(max_workers=max_workers) as pool:
+            probe_errors = list(pool.map(
+                lambda item: self._probe_csv(item[0], item[1]), files_data
+            ))
+
+        valid_files = []
+        for (file_source, filename), probe_error in zip(files_data, probe_errors):
+            if probe_error is not None:
+                self.load_errors[filename] = probe_error
+            else:
+                valid_files.append((file_source, filename))
+
+        def _load_one(file_source, filename):
+            try:
+                self.smart_load_csv(file_source, filename)
+            except Exception as e:
+                self.load_errors[filename] = str(e)
+
+        if len(valid_files) > 1:
+            with ThreadPoolExecutor(max_workers=max_workers) as pool:
+                futures = [
+                    pool.submit(_load_one, file_source, filename)
+                    for file_source, filename in valid_files
+                ]
+                for future in futures:
+                    future.result()
+        else:
+            for file_source, filename in valid_files:
+                _load_one(file_source, filename)
+
         loaded = {}
-        for file_bytes, filename in files_data:
-            self.smart_load_csv(file_bytes, filename)
+        for _, filename in valid_files:
             clean_name = Path(filename).stem
-            loaded[clean_name] = self.dataframes[clean_name]
+            if filename not in self.load_errors and clean_name in self.dataframes:
+                loaded[clean_name] = self.dataframes[clean_name]
 
-        # Первый файл - основной
-        if files_data:
-            self.current_df = loaded[Path(files_data[0][1]).stem]
+        if not loaded:
+            details = "; ".join(
+                f"{name}: {err}" for name, err in self.load_errors.items()
+            )
+            raise Exception(f"Не удалось загрузить ни один CSV файл. {details}")
+
+        # Основной DataFrame — первый успешно загруженный файл
+        for _, filename in files_data:
+            clean_name = Path(filename).stem
+            if clean_name in loaded:
+                self.current_df = loaded[clean_name]
+                break
 
         return loaded
 
@@ -307,31 +951,52 @@ class CSVAnalysisAgentAPI:
         Returns:
             Словарь с информацией о схеме
         """
+        # Схема неизменна для конкретного DataFrame — отдаем из кэша.
+        # Форма в ключе защищает от редкого случая, когда фрейм
+        # мутировали на месте (добавили/удалили строки или колонки)
+        cache_key = (id(df), df.shape)
+        cached = self._schema_cache.get(cache_key)
+        if cached is not None:
+            return cached
+
+        # Конвертации через to_dict()/astype() идут в C-коде pandas,
+        # без поэлементного Python-цикла по широким фреймам
         schema = {
             "columns": list(df.columns),
-            "dtypes": {col: str(dtype) for col, dtype in df.dtypes.items()},
+            "dtypes": df.dtypes.astype(str).to_dict(),
             "shape": {"rows": int(df.shape[0]), "columns": int(df.shape[1])},
-            "missing_values": {col: int(count) for col, count in df.isnull().sum().items()},
+            "missing_values": df.isnull().sum().astype(int).to_dict(),
             "sample_data": df.head(5).to_dict(orient='records'),
+            # Примеры значений по колонкам считаем один раз здесь,
+            # а не в цикле по ячейкам при каждой сборке промпта
+            "examples": {
+                col: df[col].dropna().head(3).astype(str).tolist()
+                for col in df.columns
+            },
             "summary_stats": {},
-            "metadata": self.data_metadata
+            # Снимок, а не живой словарь: схема кэшируется (и на сервере
+            # тоже), последующие загрузки не должны менять выданный ответ
+            "metadata": dict(self.data_metadata)
         }
 
-        # Статистика для числовых колонок
-        numeric_cols = df.select_dtypes(include=[np.number]).columns
-        if len(numeric_cols) > 0:
-            stats_df = df[numeric_cols].describe()
+        # Статистика для числовых колонок — один проход describe()
+        numeric_df = df.select_dtypes(include=[np.number])
+        if numeric_df.shape[1] > 0:
+            stats_df = numeric_df.describe().astype(float)
             schema["summary_stats"] = {
-                col: {stat: float(val) for stat, val in stats_df[col].items()}
-                for col in numeric_cols
+                col: stats_df[col].to_dict() for col in stats_df.columns
             }
 
+        self._schema_cache[cache_key] = schema
         return schema
 
     def execute_python_code(self, code: str, df: pd.DataFrame) -> Tuple[bool, Any, str, List[str]]:
         """
         Безопасное выполнение Python кода с возвращением изображений в base64
 
+        При EXEC_ISOLATION=1 код выполняется в форкнутом процессе с
+        лимитами памяти и времени (см. _execute_isolated)
+
         Args:
             code: Python код для выполнения
             df: DataFrame для работы (основной)
@@ -339,9 +1004,77 @@ class CSVAnalysisAgentAPI:
         Returns:
             Кортеж (успех, результат, вывод/ошибка, список base64 изображений)
         """
-        local_vars = {
-            'df': df.copy(),
-            'pd': pd,
+        if EXEC_ISOLATION:
+            return self._execute_isolated(code, df)
+        return self._execute_in_process(code, df)
+
+    def _execute_isolated(self, code: str, df: pd.DataFrame) -> Tuple[bool, Any, str, List[str]]:
+        """
+        Выполнение кода в форкнутом дочернем процессе
+
+        fork не копирует DataFrame физически (copy-on-write страниц ОС),
+        а обратно по pipe идет уже JSON-совместимый результат. Дочерний
+        процесс ограничен по памяти через RLIMIT_AS, по времени — через
+        poll() на родительской стороне, что работает и из рабочих потоков
+        """
+        ctx = multiprocessing.get_context('fork')
+        parent_conn, child_conn = ctx.Pipe(duplex=False)
+        proc = ctx.Process(target=self._isolated_entry, args=(child_conn, code, df))
+        proc.start()
+        child_conn.close()
+
+        try:
+            if parent_conn.poll(EXEC_TIMEOUT_SECONDS):
+                try:
+                    return tuple(parent_conn.recv())
+                except EOFError:
+                    # Процесс умер, не отправив результат (лимит памяти)
+                    return (
+                        False, None,
+                        f"MemoryError: выполнение кода превысило лимит "
+                        f"{EXEC_MEMORY_LIMIT_MB} МБ",
+                        []
+                    )
+            proc.terminate()
+            return (
+                False, None,
+                f"TimeoutError: выполнение кода превысило {EXEC_TIMEOUT_SECONDS} с",
+                []
+            )
+        finally:
+            proc.join(timeout=1)
+            if proc.is_alive():
+                proc.kill()
+            parent_conn.close()
+
+    def _isolated_entry(self, conn, code: str, df: pd.DataFrame):
+        """Точка входа дочернего процесса: ставим лимиты и выполняем"""
+        try:
+            import resource
+            limit = EXEC_MEMORY_LIMIT_MB * 1024 * 1024
+            resource.setrlimit(resource.RLIMIT_AS, (limit, limit))
+        except Exception:
+            pass
+
+        try:
+            payload = self._execute_in_process(code, df)
+        except BaseException as e:
+            payload = (False, None, f"{type(e).__name__}: {str(e)}", [])
+
+        try:
+            conn.send(payload)
+        finally:
+            conn.close()
+
+    def _execute_in_process(self, code: str, df: pd.DataFrame) -> Tuple[bool, Any, str, List[str]]:
+        """Выполнение кода в текущем процессе (основной путь)"""
+        # При Copy-on-Write copy() ленивая: буферы общие, физически
+        # копируются только блоки, которые сгенерированный код мутирует.
+        # Сам copy() оставляем — он изолирует сохраненные DataFrame'ы
+        # от мутаций вроде df['col'] = ... внутри exec-кода
+        local_vars = {
+            'df': df.copy(),
+            'pd': pd,
             'np': np,
             'plt': plt,
             'sns': sns,
@@ -352,16 +1085,22 @@ class CSVAnalysisAgentAPI:
         for name, dataframe in self.dataframes.items():
             local_vars[name] = dataframe.copy()
 
-        stdout_capture = io.StringIO()
-        stderr_capture = io.StringIO()
+        stdout_capture = _ListSink()
+        stderr_capture = _ListSink()
         plot_base64_list = []
 
         try:
-            with contextlib.redirect_stdout(stdout_capture), \
-                 contextlib.redirect_stderr(stderr_capture):
-
-                # Выполняем код
-                exec(code, local_vars)
+            # ExitStack гарантирует порядок: фигуры закрываются ДО
+            # освобождения _exec_lock, иначе фигуры упавшего exec'а
+            # достались бы следующему запросу, взявшему лок
+            with contextlib.ExitStack() as stack:
+                stack.enter_context(_exec_lock)
+                stack.callback(plt.close, 'all')
+                stack.enter_context(contextlib.redirect_stdout(stdout_capture))
+                stack.enter_context(contextlib.redirect_stderr(stderr_capture))
+
+                # Выполняем код (байткод берется из кэша)
+                exec(_compile_user_code(code), local_vars)
 
                 # Получаем результат
                 result = local_vars.get('result', None)
@@ -376,41 +1115,63 @@ class CSVAnalysisAgentAPI:
                     # Если AI вернул DataFrame вместо Markdown - конвертируем в строку
                     result = str(result)
 
-                # Сохраняем графики в base64
-                if plt.get_fignums():
-                    for fig_num in plt.get_fignums():
-                        fig = plt.figure(fig_num)
-
-                        # Сохраняем в буфер
+                # Сохраняем графики в base64: берем фигуры напрямую из
+                # Gcf, не реактивируя каждую через plt.figure()
+                fig_managers = Gcf.get_all_fig_managers()
+                if fig_managers:
+                    for manager in fig_managers:
+                        fig = manager.canvas.figure
+
+                        # Один проход tight_layout вместо bbox_inches='tight',
+                        # который рендерит фигуру дважды (сначала для
+                        # вычисления границ, потом начисто)
+                        try:
+                            fig.tight_layout()
+                        except Exception:
+                            pass
+
+                        # WebP кодируется быстрее и в разы компактнее PNG,
+                        # что уменьшает и CPU на savefig, и JSON-ответ.
+                        # PNG остается запасным вариантом (нужен Pillow
+                        # с поддержкой webp); compress_level=1 — быстрый
+                        # zlib вместо дефолтного уровня 6
                         buffer = io.BytesIO()
-                        fig.savefig(buffer, format='png', bbox_inches='tight', dpi=150)
-                        buffer.seek(0)
-
-                        # Конвертируем в base64
-                        img_base64 = base64.b64encode(buffer.read()).decode('utf-8')
-                        plot_base64_list.append(f"data:image/png;base64,{img_base64}")
+                        try:
+                            fig.savefig(buffer, format='webp', dpi=100)
+                            mime = 'image/webp'
+                        except Exception:
+                            buffer = io.BytesIO()
+                            fig.savefig(
+                                buffer, format='png', dpi=100,
+                                pil_kwargs={'optimize': False, 'compress_level': 1}
+                            )
+                            mime = 'image/png'
+
+                        # getvalue() вместо seek+read — без лишнего копирования
+                        img_base64 = base64.b64encode(buffer.getvalue()).decode('ascii')
+                        plot_base64_list.append(f"data:{mime};base64,{img_base64}")
 
                         buffer.close()
 
-                    plt.close('all')
-
                 return True, result, output, plot_base64_list
 
         except Exception as e:
-            error_msg = f"{type(e).__name__}: {str(e)}\n{traceback.format_exc()}"
+            # Компактная диагностика: однострочник + последние 3 кадра
+            # стека. Полный format_exc() форматирует весь стек фреймов —
+            # лишняя работа на каждый ретрай и лишние токены в промпте
+            frames = "".join(traceback.format_tb(e.__traceback__, limit=-3))
+            error_msg = f"{type(e).__name__}: {str(e)}\n{frames}"
             return False, None, error_msg, []
         finally:
-            # Полная очистка matplotlib
-            plt.close('all')
-            plt.clf()
-            # Очищаем локальные переменные
+            # Очищаем локальные переменные (фигуры уже закрыты под локом)
             local_vars.clear()
 
-    def generate_code_with_retry(self, user_query: str, schema: Dict,
-                                 chat_history: List[Dict] = None,
-                                 previous_error: Optional[str] = None) -> str:
+    def _build_generation_messages(self, user_query: str, schema: Dict,
+                                   chat_history: List[Dict] = None,
+                                   previous_error: Optional[str] = None) -> List[Dict]:
         """
-        Генерация Python кода с помощью AI (Julius.ai style - многоэтапный подход)
+        Сборка сообщений для API генерации кода (Julius.ai style)
+        Общая часть синхронного и асинхронного путей генерации
 
         Args:
             user_query: Запрос пользователя
@@ -419,191 +1180,70 @@ class CSVAnalysisAgentAPI:
             previous_error: Предыдущая ошибка (для повторной попытки)
 
         Returns:
-            Сгенерированный Python код
+            Список сообщений для chat.completions
         """
-        system_prompt = """Ты эксперт-аналитик данных, работающий как Julius.ai.
-
-🎯 ТВОЯ ЗАДАЧА: Писать код который работает ПОЭТАПНО и ЛОГИРУЕТ каждый шаг.
-
-📋 ОБЯЗАТЕЛЬНАЯ СТРУКТУРА КОДА:
-
-```python
-# === ШАГ 1: ПОНИМАНИЕ ДАННЫХ ===
-print("🔍 ШАГ 1: Изучаю структуру данных...")
-print(f"Размер данных: {len(df)} строк, {len(df.columns)} колонок")
-print(f"Колонки: {list(df.columns)}")
-
-# === ШАГ 2: ПРОВЕРКА И ОЧИСТКА ===
-print("\\n🧹 ШАГ 2: Проверяю качество данных...")
-
-# Ищем нужные колонки (гибкий поиск)
-def find_column(df, keywords):
-    for col in df.columns:
-        col_lower = str(col).lower()
-        if any(keyword.lower() in col_lower for keyword in keywords):
-            return col
-    return None
-
-year_col = find_column(df, ['year', 'год', 'date'])
-amount_col = find_column(df, ['amount', 'сумма', 'total', 'value'])
-
-if not year_col or not amount_col:
-    result = f"❌ Ошибка: не найдены нужные колонки. Доступные: {list(df.columns)}"
-else:
-    print(f"✅ Найдены колонки: {year_col}, {amount_col}")
-
-    # Преобразуем типы данных
-    df[year_col] = pd.to_numeric(df[year_col], errors='coerce')
-    df[amount_col] = pd.to_numeric(df[amount_col], errors='coerce')
-
-    # Удаляем строки с пустыми значениями
-    df_clean = df.dropna(subset=[year_col, amount_col])
-    print(f"✅ Данные очищены: {len(df_clean)} валидных строк")
-
-    # === ШАГ 3: АНАЛИЗ ===
-    print("\\n📊 ШАГ 3: Выполняю анализ...")
-
-    # Группировка и агрегация
-    result_df = df_clean.groupby(year_col)[amount_col].sum().reset_index()
-    result_df = result_df.sort_values(year_col)
-
-    print(f"✅ Агрегировано: {len(result_df)} групп")
-
-    # === ШАГ 4: ВИЗУАЛИЗАЦИЯ ===
-    print("\\n📈 ШАГ 4: Создаю визуализацию...")
-
-    plt.figure(figsize=(12, 6))
-    plt.plot(result_df[year_col], result_df[amount_col],
-             marker='o', linewidth=2, markersize=8)
-    plt.title('Динамика показателей', fontsize=16, fontweight='bold')
-    plt.xlabel(year_col, fontsize=12)
-    plt.ylabel(amount_col, fontsize=12)
-    plt.grid(True, alpha=0.3)
-
-    # Форматируем ось Y с запятыми
-    ax = plt.gca()
-    ax.yaxis.set_major_formatter(plt.FuncFormatter(lambda x, p: f'{x:,.0f}'))
-
-    plt.tight_layout()
-    print("✅ График создан")
-
-    # === ШАГ 5: ФОРМАТИРОВАННЫЙ РЕЗУЛЬТАТ ===
-    print("\\n✅ ШАГ 5: Формирую финальный отчет...")
-
-    # Создаем MARKDOWN таблицу (НЕ код-блок!)
-    display_df = result_df.copy()
-
-    # Форматируем числа
-    display_df[amount_col] = display_df[amount_col].apply(lambda x: f"{x:,.0f}")
-
-    # Генерируем Markdown таблицу ВРУЧНУЮ
-    markdown_table = f"| {year_col} | {amount_col} |\\n"
-    markdown_table += "|" + "-" * (len(str(year_col)) + 2) + "|" + "-" * (len(str(amount_col)) + 2) + "|\\n"
-
-    for _, row in display_df.iterrows():
-        markdown_table += f"| {int(row[year_col])} | {row[amount_col]} |\\n"
-
-    # Статистика
-    total_sum = result_df[amount_col].sum()
-    avg_value = result_df[amount_col].mean()
-
-    result = f\"\"\"
-## 📊 Результаты анализа
-
-### 📈 Данные по годам
-
-{markdown_table}
-
-### 📌 Статистика
-
-| Показатель | Значение |
-|------------|----------|
-| Всего записей | {len(df_clean)} |
-| Общая сумма | {total_sum:,.0f} |
-| Среднее значение | {avg_value:,.0f} |
-
-✅ Анализ выполнен успешно
-\"\"\"
-
-    print("✅ Анализ завершен успешно!")
-```
-
-🎯 КЛЮЧЕВЫЕ ПРАВИЛА:
-
-1. **ЛОГИРУЙ КАЖДЫЙ ШАГ** через print():
-   - Что делаешь сейчас
-   - Сколько данных обработано
-   - Какие промежуточные результаты
-
-2. **ИЩИ КОЛОНКИ ГИБКО**:
-   - Используй функцию find_column()
-   - Ищи по ключевым словам
-   - Проверяй существование
-
-3. **ПРОВЕРЯЙ ВСЁ**:
-   - Существование колонок
-   - Типы данных
-   - Пустые значения
-
-4. **ФОРМАТИРУЙ ЧИСЛА**:
-   - В таблицах: `{value:,.0f}` или `{value:,.2f}`
-   - На графиках: `plt.FuncFormatter(lambda x, p: f'{x:,.0f}')`
-
-5. **СОЗДАВАЙ MARKDOWN ТАБЛИЦЫ** (НЕ код-блоки!):
-   - Используй формат: `| Колонка | Значение |`
-   - Разделитель: `|---------|----------|`
-   - Генерируй таблицу циклом или через петлю
-   - НЕ используй ``` вокруг таблиц!
-   - Форматируй числа ПЕРЕД выводом
-
-6. **result В MARKDOWN**:
-   - Заголовки ##, ###
-   - Таблицы НАПРЯМУЮ в Markdown (| col | val |)
-   - Эмодзи для наглядности
-   - **НЕ ПЕЧАТАЙ result через print!**
-   - **НЕ ИСПОЛЬЗУЙ ``` вокруг таблиц данных!**
-
-7. **ОБРАБОТКА ОШИБОК**:
-   - Если колонки не найдены - сообщи об этом в result
-   - Покажи какие колонки доступны
-   - Дай рекомендацию пользователю
-
-Доступные DataFrame'ы: 'df' (основной){available_dataframes}
-
-Помни: ты должен работать КАК НАСТОЯЩИЙ АНАЛИТИК - пошагово, с объяснениями, с проверками!
-"""
-
-        # Добавляем информацию о дополнительных файлах в промпт
-        available_dataframes_text = ""
-        if len(self.dataframes) > 1:
-            other_files = [name for name in self.dataframes.keys()]
-            if other_files:
-                names_quoted = [f"'{name}'" for name in other_files]
+        # Динамический хвост системного промпта — отдельным блоком,
+        # чтобы не инвалидировать кэш статического префикса.
+        # Пересобираем только при смене набора загруженных файлов
+        dyn_key = tuple(sorted(self.dataframes)) if len(self.dataframes) > 1 else ()
+        if dyn_key != self._dyn_prompt_key:
+            available_dataframes_text = ""
+            if len(self.dataframes) > 1:
+                names_quoted = [f"'{name}'" for name in self.dataframes.keys()]
                 available_dataframes_text = f", {', '.join(names_quoted)}"
 
-        system_prompt = system_prompt.replace("{available_dataframes}", available_dataframes_text)
-
-        # Формируем детальное описание данных
-        column_details = []
-        for col in schema['columns']:
-            dtype = schema['dtypes'][col]
-            missing = schema['missing_values'].get(col, 0)
-
-            # Примеры значений
-            examples = []
-            if len(schema['sample_data']) > 0:
-                for row in schema['sample_data'][:3]:
-                    val = row.get(col)
-                    if pd.notna(val):
-                        examples.append(str(val))
-
-            examples_str = ", ".join(examples[:3]) if examples else "нет данных"
-
-            col_info = f"  • '{col}' ({dtype})"
-            if missing > 0:
-                col_info += f" [⚠️ пустых: {missing}]"
-            col_info += f"\n    Примеры: {examples_str}"
-            column_details.append(col_info)
+            self._dyn_prompt_key = dyn_key
+            self._dyn_prompt_text = (
+                f"Доступные DataFrame'ы: 'df' (основной){available_dataframes_text}\n\n"
+                "Помни: ты должен работать КАК НАСТОЯЩИЙ АНАЛИТИК - пошагово, "
+                "с объяснениями, с проверками!"
+            )
+        dynamic_system_text = self._dyn_prompt_text
+
+        # Сериализованное описание данных кэшируем по идентичности
+        # схемы: ретраи и follow-up'ы в рамках одного файла не платят
+        # за повторную сборку строк и JSON
+        prompt_cache_key = id(schema)
+        cached_parts = self._schema_prompt_cache.get(prompt_cache_key)
+        if cached_parts is not None:
+            columns_block, sample_json = cached_parts
+        else:
+            # Широкие CSV режем до 30 колонок: сотни колонок раздувают
+            # промпт, а LLM все равно ищет колонки по ключевым словам
+            all_columns = schema['columns']
+            shown_columns = all_columns[:30]
+
+            # Описание колонок одним проходом: примеры уже посчитаны
+            # в analyze_csv_schema, по ячейкам здесь не ходим
+            dtypes = schema['dtypes']
+            missing_values = schema['missing_values']
+            examples = schema.get('examples', {})
+            column_details = [
+                f"  • '{col}' ({dtypes[col]})"
+                + (f" [⚠️ пустых: {miss}]" if (miss := missing_values.get(col, 0)) > 0 else "")
+                + f"\n    Примеры: {', '.join(examples.get(col, [])) or 'нет данных'}"
+                for col in shown_columns
+            ]
+            if len(all_columns) > len(shown_columns):
+                column_details.append(
+                    f"  • ... и еще {len(all_columns) - len(shown_columns)} колонок: "
+                    f"{', '.join(str(col) for col in all_columns[len(shown_columns):])}"
+                )
+            columns_block = "\n".join(column_details)
+
+            # Компактный JSON без отступов; для широких фреймов — только
+            # показанные колонки
+            sample_rows = schema['sample_data'][:3]
+            if len(all_columns) > len(shown_columns):
+                sample_rows = [
+                    {col: row.get(col) for col in shown_columns}
+                    for row in sample_rows
+                ]
+            sample_json = orjson.dumps(
+                sample_rows, option=orjson.OPT_SERIALIZE_NUMPY
+            ).decode()
+
+            self._schema_prompt_cache[prompt_cache_key] = (columns_block, sample_json)
 
         user_message = f"""
 📊 ДАННЫЕ CSV ФАЙЛА:
@@ -611,10 +1251,10 @@ else:
 РАЗМЕР: {schema['shape']['rows']} строк × {schema['shape']['columns']} колонок
 
 КОЛОНКИ:
-{chr(10).join(column_details)}
+{columns_block}
 
 ПРИМЕРЫ ПЕРВЫХ СТРОК:
-{json.dumps(schema['sample_data'][:3], indent=2, ensure_ascii=False)}
+{sample_json}
 
 🎯 ЗАПРОС ПОЛЬЗОВАТЕЛЯ: {user_query}
 
@@ -629,13 +1269,29 @@ else:
         if self.data_metadata.get("first_row_is_header"):
             user_message += "\n\n✅ ПРИМЕЧАНИЕ: Первая строка CSV была автоматически преобразована в заголовки."
 
-        # Добавляем историю если есть
+        # Добавляем историю если есть: от новых к старым, пока влезает
+        # в токен-бюджет — фиксированный срез [-5:] мог как раздувать
+        # промпт, так и терять полезный контекст
         if chat_history and len(chat_history) > 0:
-            history_text = "\n\nИстория предыдущих запросов:\n"
-            for i, item in enumerate(chat_history[-5:], 1):
-                history_text += f"\n{i}. Запрос: {item.get('query', '')}\n"
+            budget = self._history_token_budget
+            included = []
+            for item in reversed(chat_history):
+                entry = f"Запрос: {item.get('query', '')}\n"
                 if item.get('success'):
-                    history_text += f"   Результат: {item.get('text_output', '')[:200]}\n"
+                    entry += f"   Результат: {item.get('text_output', '')[:200]}\n"
+                cost = len(entry) // 4  # грубая оценка: ~4 символа на токен
+                if cost > budget and included:
+                    break
+                budget -= cost
+                included.append(entry)
+            included.reverse()
+
+            history_text = "\n\nИстория предыдущих запросов:\n"
+            omitted = len(chat_history) - len(included)
+            if omitted > 0:
+                history_text += f"\n(еще {omitted} более ранних запросов опущено)\n"
+            for i, entry in enumerate(included, 1):
+                history_text += f"\n{i}. {entry}"
             user_message += history_text
 
         if previous_error:
@@ -647,60 +1303,327 @@ else:
 Исправь код, учитывая эту ошибку.
 """
 
-        # Формируем сообщения для API
-        messages = [
-            {"role": "system", "content": system_prompt},
+        # Формируем сообщения для API: статический блок помечаем
+        # cache_control, чтобы OpenRouter/Anthropic кэшировали префикс
+        return [
+            {
+                "role": "system",
+                "content": [
+                    {
+                        "type": "text",
+                        "text": self.STATIC_SYSTEM_PROMPT,
+                        "cache_control": {"type": "ephemeral"}
+                    },
+                    {"type": "text", "text": dynamic_system_text}
+                ]
+            },
             {"role": "user", "content": user_message}
         ]
 
-        # Отправляем запрос к Claude/GPT
+    def _code_cache_key(self, user_query: str, schema: Dict) -> str:
+        """
+        Ключ кэша кода: модель + отпечаток схемы + нормализованный запрос
+        Модель входит в ключ, чтобы код разных моделей не смешивался
+        """
+        schema_fp = "|".join(
+            f"{col}:{schema['dtypes'][col]}" for col in schema['columns']
+        )
+        raw = f"{self.model_key}|{schema_fp}|{_normalize_query(user_query)}"
+        return hashlib.sha1(raw.encode('utf-8')).hexdigest()
+
+    @staticmethod
+    def _strip_code_fences(code: str) -> str:
+        """Убираем markdown разметку вокруг сгенерированного кода"""
+        code = code.strip()
+        match = _FENCE_RE.match(code)
+        if match:
+            return match.group(1).strip()
+        # Оборванный ответ: открывающая ограда без закрывающей
+        if code.startswith("```python"):
+            return code[9:].strip()
+        if code.startswith("```"):
+            return code[3:].strip()
+        return code
+
+    def _raise_generation_error(self, e: Exception):
+        """Улучшенная диагностика ошибок аутентификации"""
+        error_msg = str(e)
+
+        if "401" in error_msg or "Unauthorized" in error_msg or "User not found" in error_msg:
+            raise Exception(
+                f"Ошибка аутентификации OpenRouter (401): API ключ неверный или истек. "
+                f"Проверьте OPENROUTER_API_KEY в .env файле. "
+                f"Получите новый ключ на https://openrouter.ai/keys. "
+                f"Детали: {error_msg}"
+            )
+        elif "403" in error_msg:
+            raise Exception(
+                f"Доступ запрещен (403): У API ключа нет доступа к модели {self.model} "
+                f"или недостаточно кредитов. Детали: {error_msg}"
+            )
+        elif "429" in error_msg:
+            raise Exception(
+                f"Превышен лимит запросов (429): Слишком много запросов к API. "
+                f"Подождите немного и попробуйте снова. Детали: {error_msg}"
+            )
+        else:
+            raise Exception(f"Ошибка при генерации кода: {error_msg}")
+
+    def generate_code_stream(self, user_query: str, schema: Dict,
+                             chat_history: List[Dict] = None,
+                             previous_error: Optional[str] = None,
+                             max_tokens: int = 4000):
+        """
+        Потоковая генерация кода: отдает дельты токенов по мере прихода
+
+        Поток обрывается, как только после открывающей ```-ограды
+        встретилась закрывающая — остаток ответа можно не ждать
+
+        Args:
+            user_query: Запрос пользователя
+            schema: Схема данных CSV
+            chat_history: История предыдущих сообщений
+            previous_error: Предыдущая ошибка (для повторной попытки)
+            max_tokens: Бюджет токенов ответа
+
+        Yields:
+            Строки-дельты сгенерированного кода
+        """
+        messages = self._build_generation_messages(
+            user_query, schema, chat_history, previous_error
+        )
+
         try:
-            response = self.client.chat.completions.create(
+            stream = self.client.chat.completions.create(
                 model=self.model,
                 messages=messages,
                 temperature=0.2,
-                max_tokens=4000
+                max_tokens=max_tokens,
+                stream=True,
+                # Активирует кэширование префикса у Anthropic через OpenRouter
+                extra_headers={"anthropic-beta": "prompt-caching-2024-07-31"}
             )
 
-            code = response.choices[0].message.content.strip()
+            buf = ""
+            for chunk in stream:
+                if not chunk.choices:
+                    continue
+                delta = chunk.choices[0].delta.content
+                if not delta:
+                    continue
+                buf += delta
+                yield delta
+                stripped = buf.lstrip()
+                if stripped.startswith("```") and stripped.count("```") >= 2:
+                    break
+        except Exception as e:
+            self._raise_generation_error(e)
 
-            # Убираем markdown разметку если есть
-            if code.startswith("```python"):
-                code = code[9:]
-            if code.startswith("```"):
-                code = code[3:]
-            if code.endswith("```"):
-                code = code[:-3]
+    def generate_code_with_retry(self, user_query: str, schema: Dict,
+                                 chat_history: List[Dict] = None,
+                                 previous_error: Optional[str] = None) -> str:
+        """
+        Генерация Python кода с помощью AI (Julius.ai style - многоэтапный подход)
 
-            return code.strip()
+        Args:
+            user_query: Запрос пользователя
+            schema: Схема данных CSV
+            chat_history: История предыдущих сообщений
+            previous_error: Предыдущая ошибка (для повторной попытки)
 
+        Returns:
+            Сгенерированный Python код
+        """
+        # Большинство сниппетов короткие — первая попытка идет с меньшим
+        # бюджетом токенов; если код оборвется без закрывающей ограды,
+        # попытка провалится и ретрай получит полный бюджет
+        max_tokens = 1500 if previous_error is None else 4000
+
+        chunks = []
+        for delta in self.generate_code_stream(
+            user_query, schema, chat_history, previous_error, max_tokens
+        ):
+            chunks.append(delta)
+
+        return self._strip_code_fences("".join(chunks))
+
+    async def generate_code_async(self, user_query: str, schema: Dict,
+                                  chat_history: List[Dict] = None,
+                                  previous_error: Optional[str] = None) -> str:
+        """
+        Асинхронная генерация кода: тот же промпт, но запрос к API
+        не блокирует event loop — несколько генераций идут параллельно
+
+        Args:
+            user_query: Запрос пользователя
+            schema: Схема данных CSV
+            chat_history: История предыдущих сообщений
+            previous_error: Предыдущая ошибка (для повторной попытки)
+
+        Returns:
+            Сгенерированный Python код
+        """
+        messages = self._build_generation_messages(
+            user_query, schema, chat_history, previous_error
+        )
+
+        try:
+            response = await self.aclient.chat.completions.create(
+                model=self.model,
+                messages=messages,
+                temperature=0.2,
+                max_tokens=4000,
+                extra_headers={"anthropic-beta": "prompt-caching-2024-07-31"}
+            )
+            return self._strip_code_fences(response.choices[0].message.content)
         except Exception as e:
-            error_msg = str(e)
-
-            # Улучшенная диагностика ошибок аутентификации
-            if "401" in error_msg or "Unauthorized" in error_msg or "User not found" in error_msg:
-                raise Exception(
-                    f"Ошибка аутентификации OpenRouter (401): API ключ неверный или истек. "
-                    f"Проверьте OPENROUTER_API_KEY в .env файле. "
-                    f"Получите новый ключ на https://openrouter.ai/keys. "
-                    f"Детали: {error_msg}"
-                )
-            elif "403" in error_msg:
-                raise Exception(
-                    f"Доступ запрещен (403): У API ключа нет доступа к модели {self.model} "
-                    f"или недостаточно кредитов. Детали: {error_msg}"
-                )
-            elif "429" in error_msg:
-                raise Exception(
-                    f"Превышен лимит запросов (429): Слишком много запросов к API. "
-                    f"Подождите немного и попробуйте снова. Детали: {error_msg}"
-                )
+            self._raise_generation_error(e)
+
+    async def analyze_many(self, queries: List[str]) -> List[Dict[str, Any]]:
+        """
+        Пакетный анализ независимых запросов к одному датасету
+
+        Генерация кода для всех запросов идет параллельно через
+        asyncio.gather (ожидание LLM перекрывается), а выполнение кода —
+        последовательно: matplotlib и exec делят глобальное состояние
+
+        Args:
+            queries: Список запросов пользователя
+
+        Returns:
+            Список результатов в том же порядке, что и запросы
+        """
+        if self.current_df is None:
+            return [
+                {"success": False, "error": "CSV файл не загружен", "query": q}
+                for q in queries
+            ]
+
+        schema = self.analyze_csv_schema(self.current_df)
+
+        # Генерируем только запросы, которых нет в кэше кода
+        cache_keys = [self._code_cache_key(query, schema) for query in queries]
+        codes = [_code_cache_get(key) for key in cache_keys]
+        pending = [i for i, code in enumerate(codes) if code is None]
+        if pending:
+            generated = await asyncio.gather(
+                *(self.generate_code_async(queries[i], schema) for i in pending),
+                return_exceptions=True
+            )
+            for i, code in zip(pending, generated):
+                codes[i] = code
+
+        results = []
+        for query, cache_key, code in zip(queries, cache_keys, codes):
+            if isinstance(code, BaseException):
+                results.append({
+                    "success": False,
+                    "query": query,
+                    "error": f"Ошибка генерации кода: {code}"
+                })
+                continue
+
+            success, exec_result, output, plots = self.execute_python_code(
+                code, self.current_df
+            )
+            if success:
+                _code_cache_put(cache_key, code)
+            results.append({
+                "success": success,
+                "query": query,
+                "final_code": code,
+                "result_data": exec_result if success else None,
+                "text_output": output if success else None,
+                "plots": plots,
+                "error": None if success else output
+            })
+
+        return results
+
+    def analyze_stream(self, user_query: str, chat_history: List[Dict] = None):
+        """
+        Потоковая версия анализа: генерирует события по мере выполнения,
+        чтобы клиент мог начинать рендерить результат до завершения всего
+        пайплайна (код, текст и каждый график приходят отдельными событиями)
+
+        Args:
+            user_query: Запрос пользователя
+            chat_history: История предыдущих сообщений
+
+        Yields:
+            Словари-события с полем "type":
+            status / code / text / plot / attempt_error / done / error
+        """
+        if self.current_df is None:
+            yield {"type": "error", "error": "CSV файл не загружен"}
+            return
+
+        # Получаем схему данных
+        schema = self.analyze_csv_schema(self.current_df)
+
+        # Кэш кода используем только для запросов без истории диалога:
+        # с историей тот же текст запроса может означать другое
+        cache_key = None
+        cached_code = None
+        if not chat_history:
+            cache_key = self._code_cache_key(user_query, schema)
+            cached_code = _code_cache_get(cache_key)
+
+        # Пробуем выполнить с повторными попытками
+        previous_error = None
+
+        for attempt in range(1, self.max_retries + 1):
+            yield {"type": "status", "attempt": attempt, "max_retries": self.max_retries}
+
+            if cached_code is not None and previous_error is None:
+                # Попадание в кэш — пропускаем обращение к LLM
+                code = cached_code
             else:
-                raise Exception(f"Ошибка при генерации кода: {error_msg}")
+                # Генерируем код
+                try:
+                    code = self.generate_code_with_retry(
+                        user_query,
+                        schema,
+                        chat_history,
+                        previous_error
+                    )
+                except Exception as e:
+                    yield {"type": "error", "error": f"Ошибка генерации кода: {str(e)}"}
+                    return
+
+            yield {"type": "code", "attempt": attempt, "code": code}
+
+            # Выполняем код
+            success, exec_result, output, plot_base64_list = self.execute_python_code(
+                code, self.current_df
+            )
+
+            if success:
+                # В кэш кладем только код, который реально выполнился
+                if cache_key is not None:
+                    _code_cache_put(cache_key, code)
+                yield {"type": "text", "result_data": exec_result, "text_output": output}
+                for i, plot in enumerate(plot_base64_list):
+                    yield {"type": "plot", "index": i, "data": plot}
+                yield {"type": "done", "success": True, "attempts_count": attempt}
+                return
+
+            previous_error = output
+            if cached_code is not None and attempt == 1 and cache_key is not None:
+                # Кэшированный код перестал работать — выбрасываем запись
+                _code_cache_drop(cache_key)
+            yield {"type": "attempt_error", "attempt": attempt, "error": output}
+
+        yield {
+            "type": "error",
+            "error": f"Не удалось выполнить код после {self.max_retries} попыток",
+            "error_details": previous_error
+        }
 
     def analyze(self, user_query: str, chat_history: List[Dict] = None) -> Dict[str, Any]:
         """
         Основной метод анализа для API
+        Собирает события analyze_stream в единый словарь-ответ
 
         Args:
             user_query: Запрос пользователя
@@ -716,9 +1639,6 @@ else:
                 "timestamp": datetime.utcnow().isoformat()
             }
 
-        # Получаем схему данных
-        schema = self.analyze_csv_schema(self.current_df)
-
         result = {
             "success": False,
             "query": user_query,
@@ -733,51 +1653,31 @@ else:
             "load_info": self.data_metadata
         }
 
-        # Пробуем выполнить с повторными попытками
-        previous_error = None
-
-        for attempt in range(self.max_retries):
-            result["attempts_count"] = attempt + 1
-
-            # Генерируем код
-            try:
-                code = self.generate_code_with_retry(
-                    user_query,
-                    schema,
-                    chat_history,
-                    previous_error
-                )
-
+        for event in self.analyze_stream(user_query, chat_history):
+            event_type = event["type"]
+            if event_type == "status":
+                result["attempts_count"] = event["attempt"]
+            elif event_type == "code":
                 result["code_attempts"].append({
-                    "attempt": attempt + 1,
-                    "code": code,
+                    "attempt": event["attempt"],
+                    "code": event["code"],
                     "success": False
                 })
-
-            except Exception as e:
-                result["error"] = f"Ошибка генерации кода: {str(e)}"
-                break
-
-            # Выполняем код
-            success, exec_result, output, plot_base64_list = self.execute_python_code(
-                code, self.current_df
-            )
-
-            if success:
+            elif event_type == "text":
+                result["result_data"] = event["result_data"]
+                result["text_output"] = event["text_output"]
+            elif event_type == "plot":
+                result["plots"].append(event["data"])
+            elif event_type == "attempt_error":
+                result["code_attempts"][-1]["error"] = event["error"]
+            elif event_type == "done":
                 result["success"] = True
-                result["final_code"] = code
-                result["result_data"] = exec_result
-                result["text_output"] = output
-                result["plots"] = plot_base64_list
+                result["final_code"] = result["code_attempts"][-1]["code"]
                 result["code_attempts"][-1]["success"] = True
-                break
-            else:
-                previous_error = output
-                result["code_attempts"][-1]["error"] = output
-
-                if attempt == self.max_retries - 1:
-                    result["error"] = f"Не удалось выполнить код после {self.max_retries} попыток"
-                    result["error_details"] = output
+            elif event_type == "error":
+                result["error"] = event["error"]
+                if "error_details" in event:
+                    result["error_details"] = event["error_details"]
 
         return result
 
@@ -811,13 +1711,27 @@ else:
             del self.current_df
             self.current_df = None
 
-        if self.original_df is not None:
-            del self.original_df
-            self.original_df = None
+        self._original_meta = None
 
         if self.dataframes:
             self.dataframes.clear()
 
+        self._schema_cache.clear()
+        self._schema_prompt_cache.clear()
+        self.load_errors = {}
+
+        # Сбрасываем флаги загрузки: агент возвращается в пул и будет
+        # переиспользован — устаревший first_row_is_header иначе попал бы
+        # в промпт следующего пользователя
+        self.data_metadata = {
+            "has_unnamed_columns": False,
+            "first_row_is_header": False,
+            "columns_cleaned": False,
+            "rows_removed": 0,
+            "cols_removed": 0,
+            "detected_sep": None
+        }
+
         # Закрываем все matplotlib фигуры
         plt.close('all')
 